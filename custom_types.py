@@ -1,7 +1,10 @@
-from dataclasses import dataclass
-from typing import List, Any
+from dataclasses import dataclass, field
+from typing import List, Any, Optional, Sequence, Tuple
 import numpy as np
 
+from constants import FS
+
+
 @dataclass
 class Vector:
     x: float
@@ -9,22 +12,230 @@ class Vector:
     z: float
 
 
+@dataclass
+class StreamStatistics:
+    """ Health of the measurement stream since it was started. """
+    chunks: int = 0
+    # chunks read noticeably later than the time their last sample was due by the wall clock
+    late_chunks: int = 0
+    # samples due by the wall clock but not read yet: a backlog growing with read stalls, probe clock drift and samples
+    # lost on the USB side, which the stream gives no other sign of
+    backlog_samples: int = 0
+
+
+@dataclass
+class SessionInfo:
+    fs: float
+    sensor_range: float
+    offsets: List[float]
+    start_time: float
+    # probes of a probe array, sensor_range and offsets are those of the first one
+    probes: int = 1
+    # ranges and offsets of the further probes
+    probe_ranges: List[float] = field(default_factory=list)
+    probe_offsets: List[List[float]] = field(default_factory=list)
+
+    def probe_calibration(self, probe: int) -> Tuple[float, List[float]]:
+        """ Range [mT] and offsets [mT] of a probe. """
+        if probe == 0:
+            return self.sensor_range, self.offsets
+        return self.probe_ranges[probe - 1], self.probe_offsets[probe - 1]
+
+
 @dataclass
 class MeasurementsChunk:
-    t: List[float]
+    """ Consecutive samples starting at sample index start_index, counted from the start of the stream.
+
+    Times are not stored: t is computed from the sample index and the sampling rate when needed. """
+    start_index: int
     x: List[float]
     y: List[float]
     z: List[float]
+    # latency traces (diagnostics.latency_tracer.ChunkTrace) of the chunks read from the probe that make up this one
+    traces: List[Any] = field(default_factory=list)
+    fs: float = FS
+    # chunks of the further probes of a probe array covering the same samples, empty for a single probe
+    probes: List['MeasurementsChunk'] = field(default_factory=list)
+    # 3xN int16 raw ADC counts x, y and z were decoded from, if known; lets raw count files store them losslessly
+    counts: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    @property
+    def stop_index(self) -> int:
+        """ Sample index following the last sample. """
+        return self.start_index + len(self.x)
+
+    @property
+    def t(self) -> np.ndarray:
+        """ Time of every sample [s], computed exactly from the sample indices. """
+        return np.arange(self.start_index, self.stop_index) / self.fs
+
+    def slice(self, start: int, stop: int) -> 'MeasurementsChunk':
+        """ Returns views of samples start to stop, counted from the first sample of the chunk, of all probes. """
+        return MeasurementsChunk(self.start_index + start, self.x[start:stop], self.y[start:stop], self.z[start:stop],
+                                 fs=self.fs, probes=[probe.slice(start, stop) for probe in self.probes],
+                                 counts=self.counts[:, start:stop] if self.counts is not None else None)
+
+    def copy(self) -> 'MeasurementsChunk':
+        """ Returns a copy of the samples of all probes, e.g. of views that change when a buffer is written to. """
+        return MeasurementsChunk(self.start_index, np.array(self.x), np.array(self.y), np.array(self.z),
+                                 list(self.traces), self.fs, [probe.copy() for probe in self.probes],
+                                 self.counts.copy() if self.counts is not None else None)
 
     def extend(self, new: 'MeasurementsChunk') -> None:
-        self.t.extend(new.t)
         self.x.extend(new.x)
         self.y.extend(new.y)
         self.z.extend(new.z)
+        self.traces.extend(new.traces)
+
+    @staticmethod
+    def concatenate(chunks: List['MeasurementsChunk']) -> 'MeasurementsChunk':
+        """ Chunks are expected to follow each other without gaps. """
+        if len(chunks) == 1:
+            return chunks[0]
+        return MeasurementsChunk(chunks[0].start_index, np.concatenate([c.x for c in chunks]),
+                                 np.concatenate([c.y for c in chunks]), np.concatenate([c.z for c in chunks]),
+                                 [trace for c in chunks for trace in c.traces], chunks[0].fs,
+                                 [MeasurementsChunk.concatenate([c.probes[i] for c in chunks])
+                                  for i in range(len(chunks[0].probes))],
+                                 np.hstack([c.counts for c in chunks])
+                                 if all(c.counts is not None for c in chunks) else None)
+
+    @staticmethod
+    def join_contiguous(chunks: List['MeasurementsChunk']) -> List['MeasurementsChunk']:
+        """ Concatenates the chunks following each other, a chunk starting after a gap in the sample indices starts a
+        new one, so the times of its samples stay right. """
+        joined = []
+        first = 0
+        for i in range(1, len(chunks)):
+            if chunks[i].start_index != chunks[i - 1].stop_index:
+                joined.append(MeasurementsChunk.concatenate(chunks[first:i]))
+                first = i
+        if chunks:
+            joined.append(MeasurementsChunk.concatenate(chunks[first:]))
+        return joined
 
     def drop_older_than(self, n) -> None:
-        self.t = self.t[-n:]
+        self.start_index += max(0, len(self.x) - n)
         self.x = self.x[-n:]
         self.y = self.y[-n:]
         self.z = self.z[-n:]
 
+
+class MeasurementsRingBuffer:
+    """ Fixed capacity buffer keeping the most recent measurements.
+
+    Every sample is written twice, capacity apart, so the newest n samples are always a contiguous slice and can be
+    returned as views without copying. Only values are stored, the buffer tracks the sample index of the newest
+    sample; samples missing between two chunks are stored as NaN so every sample keeps its index. Besides x, y and z
+    the buffer can hold extra value channels: x, y and z of further probes, kept by extend and returned by last, or
+    other ones, e.g. derived, accessible with extend_columns and last_columns.
+
+    With counts the raw counts of the chunks are kept as well, for raw count exports; last returns them as long as
+    every chunk stored since the buffer was cleared came with them. """
+
+    def __init__(self, capacity: int, dtype=np.float32, channels: int = 3, fs: float = FS,
+                 counts: bool = False) -> None:
+        self._capacity = capacity
+        self._fs = fs
+        self._values = np.zeros((channels, 2 * capacity), dtype=dtype)
+        self._counts = np.zeros((channels, 2 * capacity), dtype=np.int16) if counts else None
+        self._counts_complete = True
+        self._head = 0
+        self._size = 0
+        self._stop_index = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def channels(self) -> int:
+        return self._values.shape[0]
+
+    @property
+    def stop_index(self) -> int:
+        """ Sample index following the newest sample. """
+        return self._stop_index
+
+    def clear(self) -> None:
+        self._head = 0
+        self._size = 0
+        self._stop_index = 0
+        self._counts_complete = True
+
+    def extend(self, new: MeasurementsChunk) -> None:
+        """ Stores x, y and z of the chunk and of its further probes, as many as there are channels for; channels of
+        probes missing in the chunk are filled with NaN. """
+        chunks = [new] + new.probes
+        columns = [values for chunk in chunks for values in (chunk.x, chunk.y, chunk.z)]
+        del columns[self.channels:]
+        counts = None
+        if len(columns) == self.channels and all(chunk.counts is not None for chunk in chunks):
+            counts = np.vstack([chunk.counts for chunk in chunks])[:self.channels]
+        columns += [np.full(len(new), np.nan)] * (self.channels - len(columns))
+        self.extend_columns(columns, new.start_index, counts)
+
+    def extend_columns(self, values: Sequence[np.ndarray], start_index: Optional[int] = None,
+                       counts: Optional[np.ndarray] = None) -> None:
+        """ Appends samples given as one array per channel (or a channels x N array), following the newest sample if
+        start_index is None. A start_index before the newest sample restarts the buffer. counts are the raw counts of
+        all channels, if the buffer keeps counts. """
+        if start_index is not None and self._size:
+            if start_index < self._stop_index:
+                self.clear()
+            elif start_index > self._stop_index:
+                gap = min(start_index - self._stop_index, self._capacity)
+                # counts of missing samples are not used, the values tell they are missing
+                self._append(np.full((self._values.shape[0], gap), np.nan, dtype=self._values.dtype),
+                             np.zeros((self._values.shape[0], gap), dtype=np.int16))
+        if counts is None:
+            self._counts_complete = False
+        self._append(values, counts)
+        if start_index is not None:
+            self._stop_index = start_index + len(values[0])
+
+    def _append(self, values: Sequence[np.ndarray], counts: Optional[np.ndarray] = None) -> None:
+        n = len(values[0])
+        self._stop_index += n
+        skip = max(0, n - self._capacity)
+        n -= skip
+        first = min(n, self._capacity - self._head)
+        self._write(self._head, values, counts, skip, skip + first)
+        self._write(0, values, counts, skip + first, skip + n)
+        self._head = (self._head + n) % self._capacity
+        self._size = min(self._size + n, self._capacity)
+
+    def _write(self, position: int, values: Sequence[np.ndarray], counts: Optional[np.ndarray], start: int,
+               stop: int) -> None:
+        count = stop - start
+        for base in (position, position + self._capacity):
+            for channel, channel_values in enumerate(values):
+                self._values[channel, base:base + count] = channel_values[start:stop]
+            if self._counts is not None and counts is not None:
+                self._counts[:, base:base + count] = counts[:, start:stop]
+
+    def last(self, n: Optional[int] = None) -> MeasurementsChunk:
+        """ Returns views of the newest n samples (all stored samples by default), valid until the next extend. """
+        start_index, values = self.last_columns(n)
+        counts = None
+        if self._counts is not None and self._counts_complete:
+            stop = self._head + self._capacity
+            counts = self._counts[:, stop - values.shape[1]:stop]
+        return MeasurementsChunk(start_index, values[0], values[1], values[2], fs=self._fs,
+                                 probes=[MeasurementsChunk(start_index, *values[i:i + 3], fs=self._fs,
+                                                           counts=counts[i:i + 3] if counts is not None else None)
+                                         for i in range(3, self.channels - 2, 3)],
+                                 counts=counts[:3] if counts is not None else None)
+
+    def last_columns(self, n: Optional[int] = None) -> Tuple[int, np.ndarray]:
+        """ Like last, returns the sample index of the first returned sample and a view of the channels x n values
+        array. """
+        n = self._size if n is None else min(n, self._size)
+        stop = self._head + self._capacity
+        return self._stop_index - n, self._values[:, stop - n:stop]
@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import deque
+from enum import IntEnum
+from time import perf_counter
+from typing import Deque, Dict, Iterable, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_LOG_INTERVAL = 30.0
+_HISTORY_SIZE = 10000
+_PERCENTILES = (50, 90, 99)
+# log spaced histogram bin edges from 10 us to 10 s
+_HISTOGRAM_EDGES = np.logspace(-5, 1, 13)
+_HISTOGRAM_WIDTH = 40
+
+
+class Stage(IntEnum):
+    READ = 0
+    DECODE = 1
+    ENQUEUE = 2
+    DEQUEUE = 3
+    FILTER = 4
+    RENDER = 5
+
+
+class ChunkTrace:
+    """ Times at which a chunk of measurements passed the stages of the pipeline, from the USB read to the screen. """
+    __slots__ = ('times',)
+
+    def __init__(self):
+        self.times = [float('nan')] * len(Stage)
+        self.times[Stage.READ] = perf_counter()
+
+
+def stamp(traces: Iterable[ChunkTrace], stage: Stage) -> None:
+    """ Stamps all traces of a (possibly concatenated) chunk. """
+    now = perf_counter()
+    for trace in traces:
+        trace.times[stage] = now
+
+
+class LatencyTracer:
+    """ Collects the latencies of completed chunk traces: the time spent between consecutive stages and the total time
+    from the read to the render stage.
+
+    new_trace() is called by the producer when a chunk is read, complete() by the display once the chunk is rendered.
+    Both may be called from different threads. A report with percentiles and histograms of the latest latencies is
+    logged every log_interval seconds and available on demand. """
+
+    def __init__(self, log_interval: float = _DEFAULT_LOG_INTERVAL):
+        self._log_interval = log_interval
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Deque[float]] = {name: deque(maxlen=_HISTORY_SIZE) for name in self._names()}
+        self._completed = 0
+        self._next_log_time = perf_counter() + log_interval
+
+    @staticmethod
+    def _names() -> List[str]:
+        return [f'{a.name.lower()} -> {b.name.lower()}' for a, b in zip(Stage, list(Stage)[1:])] + ['total']
+
+    @staticmethod
+    def new_trace() -> ChunkTrace:
+        return ChunkTrace()
+
+    def complete(self, traces: Iterable[ChunkTrace]) -> None:
+        with self._lock:
+            for trace in traces:
+                times = trace.times
+                for name, a, b in zip(self._names(), times, times[1:]):
+                    if b - a >= 0.0:
+                        self._latencies[name].append(b - a)
+                total = times[Stage.RENDER] - times[Stage.READ]
+                if total >= 0.0:
+                    self._latencies['total'].append(total)
+                self._completed += 1
+        if perf_counter() >= self._next_log_time:
+            self._next_log_time = perf_counter() + self._log_interval
+            logger.info(self.report())
+
+    def reset(self) -> None:
+        with self._lock:
+            for latencies in self._latencies.values():
+                latencies.clear()
+            self._completed = 0
+
+    def report(self) -> str:
+        with self._lock:
+            latencies = {name: np.fromiter(values, float) for name, values in self._latencies.items()}
+            completed = self._completed
+        lines = [f'Latency of {completed} traced chunks, statistics of the last {_HISTORY_SIZE} [ms]',
+                 f'{"stage":20}' + ''.join(f'{f"p{p}":>9}' for p in _PERCENTILES) + f'{"max":>9}']
+        for name, values in latencies.items():
+            if len(values):
+                lines.append(f'{name:20}' + ''.join(f'{v * 1e3:9.2f}'
+                                                    for v in np.percentile(values, _PERCENTILES + (100,))))
+            else:
+                lines.append(f'{name:20}' + f'{"-":>9}' * (len(_PERCENTILES) + 1))
+        for name, values in latencies.items():
+            if len(values):
+                lines.append('')
+                lines.append(f'{name} histogram')
+                lines.extend(self._histogram(values))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _histogram(values: np.ndarray) -> List[str]:
+        counts, edges = np.histogram(np.clip(values, _HISTOGRAM_EDGES[0], _HISTOGRAM_EDGES[-1]), _HISTOGRAM_EDGES)
+        scale = _HISTOGRAM_WIDTH / counts.max()
+        bars = ['#' * int(np.ceil(count * scale)) for count in counts]
+        return [f'{edges[i] * 1e3:9.3f} - {edges[i + 1] * 1e3:9.3f} ms {bars[i]:{_HISTOGRAM_WIDTH}} {count}'
+                for i, count in enumerate(counts) if count]
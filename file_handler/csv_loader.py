@@ -0,0 +1,55 @@
+from typing import TextIO
+
+import numpy as np
+from pandas import read_csv
+
+from constants import FS
+from custom_types import MeasurementsChunk
+from file_handler.writers import FILE_COLUMN_NAMES, FILE_HEADER
+
+# about 100 s of samples parsed at once
+_CHUNK_ROWS = 1 << 18
+
+
+class InvalidCsvFileError(Exception):
+    pass
+
+
+def check_csv_header(file: TextIO) -> None:
+    """ Reads the header line of a CSV recording, leaving file at the first row. Recordings of a probe array have
+    columns of further probes after those of a single probe recording. """
+    header = file.readline().rstrip('\r\n')
+    if header != FILE_HEADER and not header.startswith(FILE_HEADER + ','):
+        raise InvalidCsvFileError
+
+
+def load_csv(path: str, dtype=np.float64, chunk_rows: int = _CHUNK_ROWS) -> MeasurementsChunk:
+    """ Loads a CSV recording written by CsvWriter, the first probe of a probe array recording.
+
+    The header is checked on the handle the rows are then parsed from, chunk_rows at a time with fixed column types:
+    times as float64 and readings as dtype, e.g. float32 to halve the memory needed. Only the first and the last time
+    are kept, samples are evenly spaced as CsvWriter writes NaN rows across gaps: they give the sampling rate and the
+    index of the first sample. """
+    readings = [[], [], []]
+    count = 0
+    t_first = t_last = 0.0
+    column_types = {name: dtype for name in FILE_COLUMN_NAMES[1:]}
+    column_types[FILE_COLUMN_NAMES[0]] = np.float64
+    with open(path, 'r', newline='') as file:
+        check_csv_header(file)
+        try:
+            with read_csv(file, header=None, names=FILE_COLUMN_NAMES, usecols=range(len(FILE_COLUMN_NAMES)),
+                          dtype=column_types, engine='c', chunksize=chunk_rows) as reader:
+                for chunk in reader:
+                    t = chunk[FILE_COLUMN_NAMES[0]].to_numpy()
+                    if not count:
+                        t_first = t[0]
+                    t_last = t[-1]
+                    count += len(t)
+                    for values, name in zip(readings, FILE_COLUMN_NAMES[1:]):
+                        values.append(chunk[name].to_numpy())
+        except ValueError:
+            raise InvalidCsvFileError
+    x, y, z = (np.concatenate(values) if values else np.empty(0, dtype=dtype) for values in readings)
+    fs = (count - 1) / (t_last - t_first) if count > 1 and t_last > t_first else FS
+    return MeasurementsChunk(int(round(t_first * fs)), x, y, z, fs=fs)
@@ -0,0 +1,142 @@
+import html
+import json
+import logging
+import threading
+import webbrowser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from plotly.offline import get_plotlyjs
+
+from file_handler.csv_loader import load_csv
+from file_handler.lod_pyramid import LodPyramid
+from file_handler.session_file import SessionFile, SESSION_FILE_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_POINTS = 2000
+_MAX_POINTS = 20000
+
+_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title><script>{plotlyjs}</script></head>
+<body style="margin:0">
+<div id="plot" style="width:100vw;height:100vh"></div>
+<script>
+const plot = document.getElementById('plot');
+const layout = {{title: {{text: {title_json}}}, xaxis: {{title: {{text: 'Time [s]'}}}},
+                yaxis: {{title: {{text: 'Magnetic Flux Density B [mT]'}}}}, uirevision: 'keep'}};
+const traces = [['Bx [mT]', '#ff0000'], ['By [mT]', '#00ff00'], ['Bz [mT]', '#0000ff']];
+let pending = null;
+
+async function fetchData(range) {{
+    let query = 'points=' + plot.clientWidth;
+    if (range) {{
+        query += '&t0=' + range[0] + '&t1=' + range[1];
+    }}
+    const data = await (await fetch('data?' + query)).json();
+    const plotData = traces.map(([name, color], i) =>
+        ({{x: data.t, y: data[['x', 'y', 'z'][i]], name: name, type: 'scattergl', line: {{color: color}}}}));
+    await Plotly.react(plot, plotData, layout, {{scrollZoom: true}});
+}}
+
+fetchData(null).then(() => plot.on('plotly_relayout', event => {{
+    let range = null;
+    if (event['xaxis.range[0]'] !== undefined) {{
+        range = [event['xaxis.range[0]'], event['xaxis.range[1]']];
+    }} else if (!event['xaxis.autorange']) {{
+        return;
+    }}
+    clearTimeout(pending);
+    pending = setTimeout(() => fetchData(range), 50);
+}}));
+</script>
+</body>
+</html>
+"""
+
+
+class ExplorerServer:
+    """ Serves a recording to a browser over a local HTTP server.
+
+    The page asks for the visible time window on every zoom or pan and gets back only the level of detail that fits
+    the plot width. """
+
+    def __init__(self, pyramid: LodPyramid, title: str):
+        self._pyramid = pyramid
+        self._page = _PAGE.format(title=html.escape(title), title_json=json.dumps(title),
+                                  plotlyjs=get_plotlyjs()).encode('utf-8')
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    def start(self, open_browser: bool = True) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name='explorer-server', daemon=True)
+        self._thread.start()
+        logger.info(f"Exploring recording at {self.url}")
+        if open_browser:
+            webbrowser.open(self.url)
+
+    def serve_forever(self, open_browser: bool = True) -> None:
+        if open_browser:
+            webbrowser.open(self.url)
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _data(self, query: dict) -> bytes:
+        t_start = float(query['t0'][0]) if 't0' in query else None
+        t_stop = float(query['t1'][0]) if 't1' in query else None
+        points = min(int(query.get('points', [_DEFAULT_POINTS])[0]), _MAX_POINTS)
+        t, xyz = self._pyramid.query(t_start, t_stop, points)
+        # missing samples are NaN, sent as null so the plot shows a gap
+        x, y, z = (np.where(np.isnan(values), None, values).tolist() for values in xyz)
+        return json.dumps({'t': t.tolist(), 'x': x, 'y': y, 'z': z}).encode('utf-8')
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path == '/':
+                        self._reply(server._page, 'text/html; charset=utf-8')
+                    elif url.path == '/data':
+                        self._reply(server._data(parse_qs(url.query)), 'application/json')
+                    else:
+                        self.send_error(404)
+                except (KeyError, ValueError):
+                    self.send_error(400)
+
+            def _reply(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
+
+def serve_recording(path: str, float32: bool = True) -> None:
+    """ Loads a recording and serves it in the browser until the process ends. Session files get a level of detail
+    pyramid stored next to them on first use, CSV files are loaded, as float32 readings if requested, and reduced in
+    memory. """
+    if path.lower().endswith(SESSION_FILE_EXTENSION):
+        pyramid = LodPyramid.for_session(SessionFile(path))
+    else:
+        pyramid = LodPyramid.build(load_csv(path, np.float32 if float32 else np.float64))
+    ExplorerServer(pyramid, path).serve_forever()
+
@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+from custom_types import MeasurementsChunk, SessionInfo
+from file_handler.writers import create_writer
+from interfaces.i_export_job import IExportJob
+
+logger = logging.getLogger(__name__)
+
+# about 6.5 s of samples per write, the granularity of progress and cancellation
+_CHUNK_SAMPLES = 16384
+
+
+class ExportJob(IExportJob):
+    """ Saves measurements to a file from a background thread, chunk by chunk, while the event loop keeps running.
+
+    The measurements are copied when the job is created, so they may be views of a buffer that is cleared or written
+    to while the job runs. Progress is polled; cancel() stops the job after the chunk being written and removes the
+    partial file. """
+
+    def __init__(self, path: str, measurements: MeasurementsChunk, info: SessionInfo, raw_counts: bool = False,
+                 chunk_samples: int = _CHUNK_SAMPLES):
+        self._path = path
+        self._measurements = measurements.copy()
+        self._info = info
+        self._raw_counts = raw_counts
+        self._chunk_samples = chunk_samples
+        self._samples_written = 0
+        self._cancelled = False
+        self._error: Optional[Exception] = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._export_task, name='export', daemon=True)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def progress(self) -> float:
+        """ Fraction of the samples written, from 0 to 1. """
+        return self._samples_written / len(self._measurements) if len(self._measurements) else 1.0
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self._error
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def cancel(self) -> None:
+        self._cancelled = True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Blocks until the job is done or timeout [s] passed, returns True if it is done. """
+        return self._done.wait(timeout)
+
+    def _export_task(self) -> None:
+        measurements = self._measurements
+        try:
+            writer = create_writer(self._path, self._info, self._raw_counts)
+            try:
+                for start in range(0, len(measurements), self._chunk_samples):
+                    if self._cancelled:
+                        break
+                    stop = min(start + self._chunk_samples, len(measurements))
+                    writer.write(measurements.slice(start, stop))
+                    self._samples_written = stop
+            finally:
+                writer.close()
+            if self._cancelled:
+                os.remove(self._path)
+                logger.info(f"Saving to {self._path} cancelled")
+            else:
+                logger.info(f"Saved {self._samples_written} samples to {self._path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Saving to {self._path} failed: {e}")
+            self._error = e
+        finally:
+            self._done.set()
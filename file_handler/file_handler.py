@@ -1,58 +1,95 @@
 from interfaces.i_file_explorer import IFileExplorer
 from interfaces.i_file_saver import IFileSaver
-from custom_types import MeasurementsChunk
+from custom_types import MeasurementsChunk, SessionInfo
 from tkinter import filedialog, Tk
-from pandas import read_csv, DataFrame
 from datetime import datetime
+import multiprocessing
+from multiprocessing.connection import Connection
+from file_handler.session_file import SessionFile, InvalidSessionFileError, SESSION_FILE_EXTENSION
+from file_handler.csv_loader import check_csv_header, InvalidCsvFileError
+from file_handler.export_job import ExportJob
+from file_handler.explorer_server import serve_recording
+from typing import Optional
 
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
 
-
-_FILE_COLUMN_NAMES = ['t [s]', 'Bx [mT]', 'By [mT]', 'Bz [mT]']
-_FILE_HEADER = ','.join(_FILE_COLUMN_NAMES)
+_FILE_TYPES = [("Session Files", f" {SESSION_FILE_EXTENSION}"), ("CSV Files", " .csv")]
 
 
 class InvalidFileError(Exception):
     pass
 
 
+def _check_recording(path: str) -> None:
+    try:
+        if path.lower().endswith(SESSION_FILE_EXTENSION):
+            SessionFile(path)
+        else:
+            with open(path, 'r', newline='') as file:
+                check_csv_header(file)
+    except (InvalidSessionFileError, InvalidCsvFileError, OSError):
+        raise InvalidFileError
+
+
+def _explorer_process(connection: Connection, float32: bool) -> None:
+    """ Asks for a recording, reports on connection whether it was selected and is valid, then serves it. """
+    root = Tk()
+    root.withdraw()
+    path = filedialog.askopenfilename(filetypes=_FILE_TYPES)
+    root.destroy()
+    try:
+        if path:
+            _check_recording(path)
+    except InvalidFileError:
+        connection.send(('error', path))
+        return
+    connection.send(('ok', path))
+    if path:
+        serve_recording(path, float32)
+
+
 class FileHandler(IFileExplorer, IFileSaver):
+    # hidden root window of the file dialogs, created once
+    _tk_root: Optional[Tk] = None
 
     def __init__(self):
-        Tk().withdraw()
+        if FileHandler._tk_root is None:
+            FileHandler._tk_root = Tk()
+            FileHandler._tk_root.withdraw()
+
+    @staticmethod
+    def save_to_file(measurements: MeasurementsChunk, info: SessionInfo,
+                     raw_counts: bool = False) -> Optional[ExportJob]:
+        """ Asks for a path and starts saving to it in the background. Returns the started job, None if no path was
+        selected. """
+        path = FileHandler.ask_recording_path()
+        if not path:
+            return None
+        job = ExportJob(path, measurements, info, raw_counts)
+        job.start()
+        return job
 
     @staticmethod
-    def save_to_file(measurements: MeasurementsChunk) -> None:
-        f = filedialog.asksaveasfile(initialfile=datetime.now().strftime('%d-%m-%Y_%H_%M_%S.csv'),
-                                     filetypes=[("CSV Files", " .csv")])
-        if f:
-            df = DataFrame(data={_FILE_COLUMN_NAMES[0]: measurements.t,
-                                 _FILE_COLUMN_NAMES[1]: measurements.x,
-                                 _FILE_COLUMN_NAMES[2]: measurements.y,
-                                 _FILE_COLUMN_NAMES[3]: measurements.z})
-            df.to_csv(f, index=False)
+    def ask_recording_path() -> str:
+        return filedialog.asksaveasfilename(initialfile=datetime.now().strftime('%d-%m-%Y_%H_%M_%S'),
+                                            defaultextension=SESSION_FILE_EXTENSION, filetypes=_FILE_TYPES)
 
     @staticmethod
-    def explore_file() -> None:
-
-        def make_plot(df: DataFrame):
-            fig = make_subplots(rows=1, cols=1, shared_xaxes=True)
-            fig.add_trace(go.Scattergl(x=df['t [s]'], y=df['Bx [mT]'], name='Bx [mT]', line=dict(color="#ff0000")), row=1, col=1)
-            fig.add_trace(go.Scattergl(x=df['t [s]'], y=df['By [mT]'], name='By [mT]', line=dict(color="#00ff00")), row=1, col=1)
-            fig.add_trace(go.Scattergl(x=df['t [s]'], y=df['Bz [mT]'], name='Bz [mT]', line=dict(color="#0000ff")), row=1, col=1)
-            fig.update_layout(title_text=f"{file.name}")
-            fig.update_xaxes(title_text="Time [s]", row=1, col=1)
-            fig.update_yaxes(title_text="Magnetic Flux Density B [mT]", row=1, col=1)
-            _PLOT_CONFIG = dict({'scrollZoom': True})
-            fig.show(config=_PLOT_CONFIG)
-            pass
+    def explore_file(float32: bool = True) -> None:
+        """ Opens a recording selected by the user in the browser. The file dialog, validation, loading and serving run
+        in a process of its own, so they do not compete with acquisition and rendering; the process ends with the
+        application. Blocks until a file is selected and validated, from an event loop call it through
+        asyncio.to_thread. CSV readings are loaded as float32 unless float32 is False. """
+        context = multiprocessing.get_context('spawn')
+        connection, child_connection = context.Pipe()
+        context.Process(target=_explorer_process, args=(child_connection, float32), name='explorer',
+                        daemon=True).start()
+        # only the explorer process holds the other end now, so its end is noticed
+        child_connection.close()
         try:
-            file = filedialog.askopenfile(mode='r', filetypes=[("CSV Files", " .csv")])
-            if not _FILE_HEADER == file.readline().rstrip('\n'):
-                raise InvalidFileError
-            file.seek(0)
-            df = read_csv(file)
-            make_plot(df)
-        except InvalidFileError:
+            status, _ = connection.recv()
+        except EOFError:
+            raise InvalidFileError
+        finally:
+            connection.close()
+        if status != 'ok':
             raise InvalidFileError
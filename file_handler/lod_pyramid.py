@@ -0,0 +1,138 @@
+import json
+import os
+from dataclasses import asdict
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from custom_types import MeasurementsChunk
+from file_handler.session_file import SessionFile
+
+LOD_FILE_EXTENSION = '.lod'
+
+LOD_DTYPE = np.dtype([('min', '<f4', (3,)), ('max', '<f4', (3,))])
+
+_MAGIC = b'USBLOD\x00\x01'
+_HEADER_SIZE = 4096
+_FACTOR = 8
+_MIN_LEVEL_SIZE = 256
+_BUILD_BLOCK_SIZE = _FACTOR ** 6
+
+
+def _reduce(minimum: np.ndarray, maximum: np.ndarray) -> np.ndarray:
+    """ Merges every _FACTOR consecutive entries into one, those of an incomplete tail into a last one. Missing
+    samples (NaN) are skipped, only buckets of missing samples alone stay NaN. """
+    complete = len(minimum) // _FACTOR
+    level = np.empty(-(-len(minimum) // _FACTOR), dtype=LOD_DTYPE)
+    tail = complete * _FACTOR
+    # fmin and fmax ignore NaN unless both values are NaN
+    level['min'][:complete] = np.fmin.reduce(minimum[:tail].reshape(complete, _FACTOR, 3), axis=1)
+    level['max'][:complete] = np.fmax.reduce(maximum[:tail].reshape(complete, _FACTOR, 3), axis=1)
+    if tail < len(minimum):
+        level['min'][complete] = np.fmin.reduce(minimum[tail:], axis=0)
+        level['max'][complete] = np.fmax.reduce(maximum[tail:], axis=0)
+    return level
+
+
+class LodPyramid:
+    """ Min/max level of detail pyramid over a recording.
+
+    Level 0 are the samples themselves, level k holds the minimum and maximum of every _FACTOR ** k samples. A query
+    picks the coarsest level that still gives the requested number of points for the time window, so its cost
+    depends on the number of points returned, not on the recording length. Times are computed from sample indices,
+    the pyramid stores values only.
+
+    Samples are taken from a MeasurementsChunk or a SessionFile by slices only, so raw count session files are
+    converted to mT a block at a time. """
+
+    def __init__(self, samples: Union[MeasurementsChunk, SessionFile], levels: List[np.ndarray]):
+        self._samples = samples
+        self._levels = levels
+
+    @staticmethod
+    def build(samples: Union[MeasurementsChunk, SessionFile]) -> 'LodPyramid':
+        """ Builds the first level in blocks, so memory mapped recordings are never loaded at once. """
+        first_level = []
+        for start in range(0, len(samples), _BUILD_BLOCK_SIZE):
+            block = samples.slice(start, start + _BUILD_BLOCK_SIZE)
+            xyz = np.column_stack((block.x, block.y, block.z))
+            first_level.append(_reduce(xyz, xyz))
+        levels = [np.concatenate(first_level) if first_level else np.empty(0, dtype=LOD_DTYPE)]
+        while len(levels[-1]) > _MIN_LEVEL_SIZE:
+            previous = levels[-1]
+            levels.append(_reduce(previous['min'], previous['max']))
+        return LodPyramid(samples, levels)
+
+    @staticmethod
+    def for_session(session: SessionFile) -> 'LodPyramid':
+        """ Loads the pyramid stored alongside a session file, building and storing it first if needed. The stored
+        pyramid keeps the calibration it was built with and is rebuilt once the file was recalibrated. """
+        path = session.path + LOD_FILE_EXTENSION
+        calibration = [asdict(segment) for segment in session.calibration]
+        pyramid = LodPyramid._load(session, path, calibration) if os.path.exists(path) else None
+        if pyramid is None:
+            pyramid = LodPyramid.build(session)
+            pyramid._save(path, calibration)
+        return pyramid
+
+    def query(self, t_start: Optional[float], t_stop: Optional[float],
+              max_points: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns t and 3 x N x, y, z of at most about max_points points per axis covering [t_start, t_stop], the
+        whole recording if t_start and t_stop are None. Min and max of coarse levels are returned as consecutive
+        points at the same time. """
+        samples = self._samples
+        fs = samples.fs
+
+        def record(index: int) -> int:
+            return min(max(0, index - samples.start_index), len(samples))
+
+        start = record(int(np.ceil(t_start * fs))) if t_start is not None else 0
+        stop = record(int(np.floor(t_stop * fs)) + 1) if t_stop is not None else len(samples)
+        level = 0
+        while level < len(self._levels) and (stop - start) // _FACTOR ** level > max_points:
+            level += 1
+
+        if level == 0:
+            window = samples.slice(start, stop)
+            return window.t, np.vstack((window.x, window.y, window.z))
+
+        bucket_size = _FACTOR ** level
+        first = max(0, start // bucket_size - 1)
+        entries = self._levels[level - 1][first:stop // bucket_size + 1]
+        t = np.repeat(samples.start_index + (first + np.arange(len(entries))) * bucket_size, 2) / fs
+        xyz = np.empty((3, 2 * len(entries)), dtype=LOD_DTYPE['min'].base)
+        xyz[:, 0::2] = entries['min'].T
+        xyz[:, 1::2] = entries['max'].T
+        return t, xyz
+
+    def _save(self, path: str, calibration: list) -> None:
+        header = json.dumps({'sample_count': len(self._samples), 'factor': _FACTOR, 'calibration': calibration,
+                             'levels': [len(level) for level in self._levels]}).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(_MAGIC + header.ljust(_HEADER_SIZE - len(_MAGIC), b' '))
+            for level in self._levels:
+                f.write(level.tobytes())
+
+    @staticmethod
+    def _load(session: SessionFile, path: str, calibration: list) -> Optional['LodPyramid']:
+        """ Returns None if the stored pyramid does not match the recording or its calibration. """
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER_SIZE)
+        if not header.startswith(_MAGIC):
+            return None
+        try:
+            content = json.loads(header[len(_MAGIC):].decode('utf-8'))
+        except ValueError:
+            return None
+        if content.get('sample_count') != len(session) or content.get('factor') != _FACTOR \
+                or content.get('calibration') != calibration:
+            return None
+        levels = []
+        offset = _HEADER_SIZE
+        for count in content['levels']:
+            levels.append(np.memmap(path, dtype=LOD_DTYPE, mode='r', offset=offset, shape=(count,)) if count
+                          else np.empty(0, dtype=LOD_DTYPE))
+            offset += count * LOD_DTYPE.itemsize
+        if offset != os.path.getsize(path):
+            return None
+        return LodPyramid(session, levels)
@@ -0,0 +1,298 @@
+import json
+import os
+from dataclasses import dataclass, asdict, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from custom_types import MeasurementsChunk, SessionInfo
+
+SESSION_FILE_EXTENSION = '.mag'
+
+SAMPLE_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+# raw ADC counts, converted to mT with the calibration segment they belong to when read
+RAW_SAMPLE_DTYPE = np.dtype([('x', '<i2'), ('y', '<i2'), ('z', '<i2')])
+# raw count of missing samples, negative full scale readings are stored as -32767
+MISSING_COUNT = -2 ** 15
+
+_MAGIC = b'USBMAG\x00\x01'
+_HEADER_SIZE = 4096
+_WRITE_BUFFER_SIZE = 1 << 20
+
+
+class InvalidSessionFileError(Exception):
+    pass
+
+
+def probe_columns(probe: int) -> List[str]:
+    """ Names of the x, y and z columns of a probe: x, y, z for the first one, x1, y1, z1 for the second and so on. """
+    suffix = str(probe) if probe else ''
+    return ['x' + suffix, 'y' + suffix, 'z' + suffix]
+
+
+def sample_dtype(probes: int = 1, raw: bool = False) -> np.dtype:
+    """ Record of a group of x, y and z columns per probe, SAMPLE_DTYPE or RAW_SAMPLE_DTYPE for a single probe. """
+    return np.dtype([(name, '<i2' if raw else '<f4') for probe in range(probes) for name in probe_columns(probe)])
+
+
+@dataclass
+class CalibrationSegment:
+    """ Calibration of the raw counts of a probe from record start up to the start of its next segment. """
+    start: int
+    sensor_range: float
+    offsets: List[float]
+    probe: int = 0
+
+    def to_mt(self, counts: np.ndarray) -> np.ndarray:
+        """ Converts a 3xN array of counts like the packet decoder, missing samples become NaN. """
+        values = counts.astype(np.float32)
+        values *= self.sensor_range / 2.0 ** 15
+        values -= np.array(self.offsets, dtype=np.float32)[:, np.newaxis]
+        values[counts == MISSING_COUNT] = np.nan
+        return values
+
+    def to_counts(self, values: np.ndarray) -> np.ndarray:
+        """ Inverse of to_mt(). Decoded readings, also as float32, convert back to the exact counts. """
+        counts = np.round((values + np.array(self.offsets)[:, np.newaxis]) / (self.sensor_range / 2.0 ** 15))
+        counts = np.clip(counts, MISSING_COUNT + 1, 2 ** 15 - 1)
+        counts[np.isnan(values)] = MISSING_COUNT
+        return counts.astype(np.int16)
+
+
+@dataclass
+class SessionHeader:
+    info: SessionInfo
+    sample_count: int = 0
+    # sample index of the first record, the time of record i is (start_index + i) / info.fs
+    start_index: int = 0
+    columns: list = field(default_factory=lambda: [list(c) for c in SAMPLE_DTYPE.descr])
+    # segments of raw count files, ordered by start for every probe
+    calibration: List[CalibrationSegment] = field(default_factory=list)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype([tuple(c) for c in self.columns])
+
+    @property
+    def raw(self) -> bool:
+        return self.dtype == sample_dtype(self.info.probes, raw=True)
+
+    def to_bytes(self) -> bytes:
+        content = json.dumps(asdict(self)).encode('utf-8')
+        if len(_MAGIC) + len(content) > _HEADER_SIZE:
+            raise ValueError('Session header too long')
+        return _MAGIC + content.ljust(_HEADER_SIZE - len(_MAGIC), b' ')
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'SessionHeader':
+        if len(data) != _HEADER_SIZE or not data.startswith(_MAGIC):
+            raise InvalidSessionFileError
+        try:
+            content = json.loads(data[len(_MAGIC):].decode('utf-8'))
+            header = SessionHeader(SessionInfo(**content['info']), content['sample_count'], content['start_index'],
+                                   content['columns'],
+                                   [CalibrationSegment(**segment) for segment in content['calibration']])
+        except (ValueError, KeyError, TypeError):
+            raise InvalidSessionFileError
+        if header.dtype not in (sample_dtype(header.info.probes), sample_dtype(header.info.probes, raw=True)):
+            raise InvalidSessionFileError
+        if header.raw and any(not header.segments(probe) or header.segments(probe)[0].start != 0
+                              for probe in range(header.info.probes)):
+            raise InvalidSessionFileError
+        return header
+
+    def segments(self, probe: int) -> List[CalibrationSegment]:
+        return [segment for segment in self.calibration if segment.probe == probe]
+
+
+class SessionWriter:
+    """ Writes a session file: a fixed size self-describing header followed by fixed width sample records.
+
+    Times are not stored, the header holds the sample index of the first record and samples missing between chunks
+    are written as NaN records. The sample count in the header is updated on close. Files left without it, e.g. after
+    a crash, are still readable, the count is then derived from the file size. Records hold a group of x, y and z
+    columns for each of info.probes probes, taken from MeasurementsChunk.probes after the first one.
+
+    With raw_counts the lossless ADC counts are stored instead of mT, in half the size, along with the range and
+    offsets of every calibration segment of every probe, starting with those of info. They are converted to mT when
+    read and can be recalibrated later. The counts are taken from MeasurementsChunk.counts, and only computed back
+    from mT for chunks without them. """
+
+    def __init__(self, path: str, info: SessionInfo, raw_counts: bool = False):
+        self._header = SessionHeader(info, columns=[list(c) for c in sample_dtype(info.probes, raw_counts).descr])
+        if raw_counts:
+            self._header.calibration = [CalibrationSegment(0, *info.probe_calibration(probe), probe)
+                                        for probe in range(info.probes)]
+        self._file = open(path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        self._file.write(self._header.to_bytes())
+        self._stop_index: Optional[int] = None
+
+    def set_calibration(self, sensor_range: float, offsets: List[float], probe: int = 0) -> None:
+        """ Starts a calibration segment of a probe with the next record written, e.g. after the range changed. Only
+        raw count files store the calibration, float files keep writing mT. """
+        if not self._header.raw:
+            return
+        segment = CalibrationSegment(self._header.sample_count, sensor_range, list(offsets), probe)
+        last = self._header.segments(probe)[-1]
+        if last.start == segment.start:
+            self._header.calibration[self._header.calibration.index(last)] = segment
+        else:
+            self._header.calibration.append(segment)
+        self._write_header()
+
+    def write(self, measurements: MeasurementsChunk) -> None:
+        if self._stop_index is None:
+            self._header.start_index = self._stop_index = measurements.start_index
+            self._write_header()
+        gap = max(0, measurements.start_index - self._stop_index)
+        records = np.empty(gap + len(measurements), dtype=self._header.dtype)
+        missing = MISSING_COUNT if self._header.raw else np.nan
+        chunks = [measurements] + measurements.probes
+        for probe in range(self._header.info.probes):
+            names = probe_columns(probe)
+            for name in names:
+                records[name][:gap] = missing
+            if probe >= len(chunks):
+                for name in names:
+                    records[name][gap:] = missing
+                continue
+            xyz = np.vstack((chunks[probe].x, chunks[probe].y, chunks[probe].z))
+            if self._header.raw:
+                xyz = self._counts(chunks[probe], xyz, probe)
+            for name, column in zip(names, xyz):
+                records[name][gap:] = column
+        self._file.write(records.tobytes())
+        self._header.sample_count += len(records)
+        self._stop_index += len(records)
+
+    def _counts(self, measurements: MeasurementsChunk, xyz: np.ndarray, probe: int) -> np.ndarray:
+        if measurements.counts is None:
+            return self._header.segments(probe)[-1].to_counts(xyz)
+        counts = np.maximum(measurements.counts, MISSING_COUNT + 1)
+        counts[np.isnan(xyz)] = MISSING_COUNT
+        return counts
+
+    def _write_header(self) -> None:
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(self._header.to_bytes())
+        self._file.seek(position)
+
+    def close(self) -> None:
+        self._write_header()
+        self._file.close()
+
+
+class SessionFile:
+    """ Read only view of a session file. Samples are memory mapped, slicing does not read the whole file. Raw counts
+    are converted to mT for the slice requested only. Samples are those of the first probe unless another one of a
+    probe array recording is selected. """
+
+    def __init__(self, path: str):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._header = SessionHeader.from_bytes(f.read(_HEADER_SIZE))
+        dtype = self._header.dtype
+        sample_count = (os.path.getsize(path) - _HEADER_SIZE) // dtype.itemsize
+        if self._header.sample_count:
+            sample_count = min(sample_count, self._header.sample_count)
+        self._samples = np.memmap(path, dtype=dtype, mode='r', offset=_HEADER_SIZE, shape=(sample_count,)) \
+            if sample_count else np.empty(0, dtype=dtype)
+        self._start_index = self._header.start_index
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def info(self) -> SessionInfo:
+        return self._header.info
+
+    @property
+    def raw(self) -> bool:
+        """ True if the file stores raw counts. """
+        return self._header.raw
+
+    @property
+    def calibration(self) -> List[CalibrationSegment]:
+        return self._header.calibration
+
+    @property
+    def probes(self) -> int:
+        return self.info.probes
+
+    @property
+    def fs(self) -> float:
+        return self.info.fs
+
+    @property
+    def start_index(self) -> int:
+        """ Sample index of the first record. """
+        return self._start_index
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def counts(self, start: int = 0, stop: Optional[int] = None, probe: int = 0) -> np.ndarray:
+        """ Returns the raw counts of records start to stop as a 3xN array. """
+        if not self.raw:
+            raise InvalidSessionFileError('No raw counts stored')
+        start, stop, _ = slice(start, stop).indices(len(self._samples))
+        records = self._samples[start:stop]
+        return np.vstack([records[name] for name in probe_columns(probe)])
+
+    def samples(self, start: int = 0, stop: Optional[int] = None, probe: int = 0) -> MeasurementsChunk:
+        """ Returns records start to stop, counted from the first record of the file. """
+        start, stop, _ = slice(start, stop).indices(len(self._samples))
+        if self.raw:
+            x, y, z = self._calibrated(start, stop, probe)
+            return MeasurementsChunk(self._start_index + start, x, y, z, fs=self.info.fs)
+        records = self._samples[start:stop]
+        x, y, z = (records[name] for name in probe_columns(probe))
+        return MeasurementsChunk(self._start_index + start, x, y, z, fs=self.info.fs)
+
+    def slice(self, start: int, stop: int) -> MeasurementsChunk:
+        """ Same as samples(start, stop), so a session file can stand in for a MeasurementsChunk, e.g. in
+        LodPyramid. """
+        return self.samples(start, stop)
+
+    def time_slice(self, t_start: float, t_stop: float) -> MeasurementsChunk:
+        """ Returns the samples with t_start <= t < t_stop. """
+        def record(t: float) -> int:
+            return min(max(0, int(np.ceil(t * self.info.fs)) - self._start_index), len(self._samples))
+        return self.samples(record(t_start), record(t_stop))
+
+    def _calibrated(self, start: int, stop: int, probe: int) -> np.ndarray:
+        counts = self.counts(start, stop, probe)
+        values = np.empty(counts.shape, dtype=np.float32)
+        segments = self._header.segments(probe)
+        for segment, following in zip(segments, segments[1:] + [None]):
+            a = max(segment.start, start) - start
+            b = (min(following.start, stop) if following else stop) - start
+            if a < b:
+                values[:, a:b] = segment.to_mt(counts[:, a:b])
+        return values
+
+
+def recalibrate(path: str, offsets: Dict[float, List[float]], probe: Optional[int] = None) -> None:
+    """ Replaces the offsets of the calibration segments of a raw count session file recorded in the ranges [mT]
+    given as keys of offsets, e.g. with improved calibration constants, for the given probe of a probe array or for all
+    probes if None. Only the header is rewritten, a level of detail pyramid stored alongside is rebuilt when next
+    used. """
+    with open(path, 'r+b') as f:
+        header = SessionHeader.from_bytes(f.read(_HEADER_SIZE))
+        if not header.raw:
+            raise InvalidSessionFileError('No raw counts stored')
+        info = header.info
+        for segment in header.calibration:
+            if probe in (None, segment.probe) and segment.sensor_range in offsets:
+                segment.offsets = list(offsets[segment.sensor_range])
+        for index in range(info.probes):
+            sensor_range, _ = info.probe_calibration(index)
+            if probe in (None, index) and sensor_range in offsets:
+                if index:
+                    info.probe_offsets[index - 1] = list(offsets[sensor_range])
+                else:
+                    info.offsets = list(offsets[sensor_range])
+        f.seek(0)
+        f.write(header.to_bytes())
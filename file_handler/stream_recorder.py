@@ -0,0 +1,91 @@
+import logging
+import threading
+from collections import deque
+from queue import Full, Queue
+from typing import Optional
+
+from custom_types import MeasurementsChunk, SessionInfo
+from file_handler.writers import create_writer
+
+logger = logging.getLogger(__name__)
+
+_MAX_PENDING_CHUNKS = 256
+
+
+class StreamRecorder:
+    """ Appends measurements to a file from a background thread while acquisition is running.
+
+    Memory use is bounded by the pending chunks queue and write() never blocks acquisition: if the disk cannot keep up,
+    chunks arriving while the queue is full are dropped and counted, leaving a gap in the file. close() blocks until
+    the writer thread is done, from an event loop call it through asyncio.to_thread. """
+
+    def __init__(self, path: str, info: SessionInfo, raw_counts: bool = False):
+        self._path = path
+        self._writer = create_writer(path, info, raw_counts)
+        self._pending: Queue = Queue(_MAX_PENDING_CHUNKS)
+        self._calibrations = deque()
+        self._samples_written = 0
+        self._dropped_chunks = 0
+        self._error: Optional[Exception] = None
+        self._writer_thread = threading.Thread(target=self._writer_task, name='stream-recorder', daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def samples_written(self) -> int:
+        return self._samples_written
+
+    @property
+    def dropped_chunks(self) -> int:
+        """ Number of chunks not recorded because the writer thread fell behind. """
+        return self._dropped_chunks
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self._error
+
+    def write(self, measurements: MeasurementsChunk) -> None:
+        """ Chunks are handed over without copying, they must not be modified afterwards. """
+        if self._error is None:
+            try:
+                self._pending.put_nowait(measurements)
+            except Full:
+                self._dropped_chunks += 1
+
+    def set_calibration(self, start_index: int, info: SessionInfo) -> None:
+        """ Records the chunks from sample index start_index on with the ranges and offsets of the probes in info, see
+        SessionWriter.set_calibration(). Never blocks, chunks handed over before keep the previous calibration. """
+        self._calibrations.append((start_index, info))
+
+    def close(self) -> None:
+        """ Blocks until all pending chunks are written and the file is closed. """
+        self._pending.put(None)
+        self._writer_thread.join()
+
+    def _writer_task(self) -> None:
+        try:
+            while True:
+                measurements: Optional[MeasurementsChunk] = self._pending.get()
+                if measurements is None:
+                    break
+                while self._calibrations and self._calibrations[0][0] <= measurements.start_index:
+                    _, info = self._calibrations.popleft()
+                    for probe in range(info.probes):
+                        self._writer.set_calibration(*info.probe_calibration(probe), probe)
+                if self._error is None:
+                    self._write_chunk(measurements)
+        finally:
+            self._writer.close()
+            logger.info(f"Recorded {self._samples_written} samples to {self._path}, "
+                        f"{self._dropped_chunks} chunks dropped")
+
+    def _write_chunk(self, measurements: MeasurementsChunk) -> None:
+        try:
+            self._writer.write(measurements)
+            self._samples_written += len(measurements)
+        except (OSError, ValueError) as e:
+            logger.error(f"Recording to {self._path} failed: {e}")
+            self._error = e
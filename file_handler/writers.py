@@ -0,0 +1,60 @@
+from typing import List, Optional
+
+import numpy as np
+
+from custom_types import MeasurementsChunk, SessionInfo
+from file_handler.session_file import SessionWriter, SESSION_FILE_EXTENSION
+
+FILE_COLUMN_NAMES = ['t [s]', 'Bx [mT]', 'By [mT]', 'Bz [mT]']
+FILE_HEADER = ','.join(FILE_COLUMN_NAMES)
+
+_WRITE_BUFFER_SIZE = 1 << 20
+_TIME_FORMAT = '%.6f'
+_VALUE_FORMAT = '%.5f'
+
+
+def _probe_column_names(probe: int) -> List[str]:
+    return [f'B{axis}{probe if probe else ""} [mT]' for axis in 'xyz']
+
+
+class CsvWriter:
+    """ Writes measurements as CSV, with the time column computed from the sample indices. Like in session files,
+    samples missing between chunks are written as NaN rows, so rows stay evenly spaced in time. Further probes of a
+    probe array get x, y and z columns of their own after those of the first probe, which keeps the header of a single
+    probe file at its start. """
+
+    def __init__(self, path: str, probes: int = 1):
+        self._probes = probes
+        self._stop_index: Optional[int] = None
+        self._file = open(path, 'w', buffering=_WRITE_BUFFER_SIZE, newline='')
+        self._file.write(','.join(FILE_COLUMN_NAMES[:1] + [name for probe in range(probes)
+                                                           for name in _probe_column_names(probe)]) + '\n')
+
+    def write(self, measurements: MeasurementsChunk) -> None:
+        if self._stop_index is not None and measurements.start_index > self._stop_index:
+            missing = np.full(measurements.start_index - self._stop_index, np.nan)
+            self._write_rows(MeasurementsChunk(self._stop_index, missing, missing, missing, fs=measurements.fs))
+        self._write_rows(measurements)
+        self._stop_index = measurements.stop_index
+
+    def _write_rows(self, measurements: MeasurementsChunk) -> None:
+        columns = [measurements.t]
+        for probe in [measurements] + measurements.probes[:self._probes - 1]:
+            columns += [probe.x, probe.y, probe.z]
+        columns += [np.full(len(measurements), np.nan)] * (1 + 3 * self._probes - len(columns))
+        np.savetxt(self._file, np.column_stack(columns), fmt=[_TIME_FORMAT] + [_VALUE_FORMAT] * 3 * self._probes,
+                   delimiter=',')
+
+    def set_calibration(self, sensor_range: float, offsets: List[float], probe: int = 0) -> None:
+        """ CSV files store mT, the calibration is not recorded. """
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def create_writer(path: str, info: SessionInfo, raw_counts: bool = False):
+    """ Session files are written for the .mag extension, CSV otherwise. raw_counts applies to session files only, CSV
+    files always store mT. """
+    if path.lower().endswith(SESSION_FILE_EXTENSION):
+        return SessionWriter(path, info, raw_counts)
+    return CsvWriter(path, info.probes)
@@ -0,0 +1,49 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class MinMaxDecimator:
+    """ Reduces a stream of multichannel samples to the minimum and maximum of every bucket of bucket_size samples.
+
+    Each bucket yields two points per channel, ordered as they occurred, so short spikes survive decimation. Samples of
+    an incomplete bucket are kept until the next chunk completes it. """
+
+    def __init__(self, bucket_size: int):
+        self._bucket_size = max(1, bucket_size)
+        self._t_pending = np.empty(0, dtype=float)
+        self._values_pending: Optional[np.ndarray] = None
+
+    @property
+    def bucket_size(self) -> int:
+        return self._bucket_size
+
+    def process(self, t: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Takes t and a channels x N values array, returns decimated t and channels x M values for all buckets
+        completed by this chunk. """
+        t = np.concatenate((self._t_pending, t))
+        if self._values_pending is not None:
+            values = np.concatenate((self._values_pending, values), axis=1)
+        buckets = len(t) // self._bucket_size
+        complete = buckets * self._bucket_size
+        self._t_pending = t[complete:]
+        self._values_pending = values[:, complete:]
+
+        if self._bucket_size == 1:
+            return t[:complete], values[:, :complete]
+
+        channels = values.shape[0]
+        samples = values[:, :complete].reshape(channels, buckets, self._bucket_size)
+        arg_min = samples.argmin(axis=2)
+        arg_max = samples.argmax(axis=2)
+        minimum = np.take_along_axis(samples, arg_min[..., np.newaxis], axis=2)[..., 0]
+        maximum = np.take_along_axis(samples, arg_max[..., np.newaxis], axis=2)[..., 0]
+        min_first = arg_min <= arg_max
+
+        decimated = np.empty((channels, 2 * buckets), dtype=values.dtype)
+        decimated[:, 0::2] = np.where(min_first, minimum, maximum)
+        decimated[:, 1::2] = np.where(min_first, maximum, minimum)
+        t_decimated = np.empty(2 * buckets, dtype=float)
+        t_decimated[0::2] = t[0:complete:self._bucket_size]
+        t_decimated[1::2] = t[self._bucket_size // 2:complete:self._bucket_size]
+        return t_decimated, decimated
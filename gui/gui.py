@@ -3,23 +3,28 @@ import typing
 from typing import Optional
 import logging
 
-import numpy as np
-
-from gui.gui_frontend import GuifrontendApp
+from gui.gui_frontend import GuifrontendApp, DiagnosticsPopup
+from gui.render_scheduler import RenderScheduler
+from processing.filter_bank import FilterBank
+from diagnostics.latency_tracer import LatencyTracer, Stage, stamp
 from custom_types import MeasurementsChunk
-from custom_types import Vector
 from interfaces.i_gui_controller import IGuiController, SensorRange
 from interfaces.i_gui_observer import IGuiObserver
 from interfaces.i_gui_subject import IGuiSubject
 
 logger = logging.getLogger(__name__)
 
+_DEFAULT_RENDER_FPS = 30.0
+
 
 class Gui(IGuiController, IGuiSubject):
 
-    def __init__(self) -> None:
+    def __init__(self, render_fps: float = _DEFAULT_RENDER_FPS, tracer: Optional[LatencyTracer] = None) -> None:
         self._gui_observer: Optional[IGuiObserver] = None
+        self._tracer = tracer
         self._gui_app = GuifrontendApp()
+        self._filter_bank = FilterBank()
+        self._render_scheduler = RenderScheduler(self._render, render_fps)
         self._gui_task = asyncio.create_task(self._run())
 
     async def _run(self):
@@ -27,26 +32,53 @@ class Gui(IGuiController, IGuiSubject):
 
     async def wait_until_initialized(self) -> None:
         await self._gui_app.wait_until_started()
+        self._gui_app.root_layout.ids.filtered_measurements.attach_filter_bank(self._filter_bank)
+        self._gui_app.root_layout.ids.graph.attach_filter_bank(self._filter_bank)
+        self._gui_app.root_layout.ids.spectrum.attach_filter_bank(self._filter_bank)
+
+    @property
+    def skipped_frames(self) -> int:
+        return self._render_scheduler.skipped_frames
 
-    def update_measurement_text_field(self, measurements: MeasurementsChunk) -> None:
-        self._gui_app.root_layout.ids.filtered_measurements.update(measurements)
+    def set_render_fps(self, fps: float) -> None:
+        self._render_scheduler.set_fps(fps)
+
+    def update_measurements(self, measurements: MeasurementsChunk) -> None:
+        self._render_scheduler.submit(measurements)
 
     def reset_measurement_text_field(self) -> None:
         self._gui_app.root_layout.ids.filtered_measurements.reset()
 
-    def update_graph(self, measurements: MeasurementsChunk) -> None:
-        self._gui_app.root_layout.ids.graph.update_data(measurements)
-        self._gui_app.root_layout.ids.graph.update_plot()
-
     def reset_graph(self) -> None:
+        self._render_scheduler.clear()
+        self._filter_bank.reset()
         self._gui_app.root_layout.ids.graph.reset()
+        self._gui_app.root_layout.ids.spectrum.reset()
+
+    def _render(self, measurements: MeasurementsChunk) -> None:
+        """ Filters the measurements once for all display widgets subscribed to the filter bank. """
+        self._filter_bank.process(measurements)
+        stamp(measurements.traces, Stage.FILTER)
+        self._gui_app.root_layout.ids.graph.update_plot()
+        self._gui_app.root_layout.ids.spectrum.update_plot()
+        stamp(measurements.traces, Stage.RENDER)
+        if self._tracer:
+            self._tracer.complete(measurements.traces)
 
     def show_info(self, text: str, warning: bool = False):
         self._gui_app.root_layout.ids.info_bar.set_message(text, warning)
 
+    def show_diagnostics(self, text: str) -> None:
+        scheduler = self._render_scheduler
+        DiagnosticsPopup(f'Frames rendered: {scheduler.rendered_frames}, skipped: {scheduler.skipped_frames}\n'
+                         + text).open()
+
     def set_start_button_active(self, active: bool) -> None:
         self._gui_app.root_layout.ids.start_button.set_active(active)
 
+    def set_record_button_active(self, active: bool) -> None:
+        self._gui_app.root_layout.ids.record_button.set_active(active)
+
     def set_stop_button_active(self, active: bool) -> None:
         self._gui_app.root_layout.ids.stop_button.set_active(active)
 
@@ -61,6 +93,9 @@ class Gui(IGuiController, IGuiSubject):
     def set_save_data_button(self, active: bool) -> None:
         self._gui_app.root_layout.ids.save_data_button.set_active(active)
 
+    def set_cancel_export_button(self, active: bool) -> None:
+        self._gui_app.root_layout.ids.cancel_export_button.set_active(active)
+
     def highlight_range_button(self, range: SensorRange) -> None:
         def unhiglight_all():
             self._gui_app.root_layout.ids.range_25_mt_button.set_highlighted(False)
@@ -79,12 +114,15 @@ class Gui(IGuiController, IGuiSubject):
         self._gui_observer = observer
         gui_ids = self._gui_app.root_layout.ids
         gui_ids.start_button.set_on_press_callback(observer.on_start_button)
+        gui_ids.record_button.set_on_press_callback(observer.on_record_button)
         gui_ids.stop_button.set_on_press_callback(observer.on_stop_button)
         gui_ids.range_25_mt_button.set_on_press_callback(observer.on_25_mt_range_button)
         gui_ids.range_50_mt_button.set_on_press_callback(observer.on_50_mt_range_button)
         gui_ids.range_100_mt_button.set_on_press_callback(observer.on_100_mt_range_button)
         gui_ids.explore_data_button.set_on_press_callback(observer.on_explore_data_button)
         gui_ids.save_data_button.set_on_press_callback(observer.on_save_data_button)
+        gui_ids.cancel_export_button.set_on_press_callback(observer.on_cancel_export_button)
+        gui_ids.diagnostics_button.set_on_press_callback(observer.on_diagnostics_button)
 
     def set_fixed_rate_panel_active(self, active: bool) -> None:
         self._gui_app.root_layout.ids.fixed_rate_panel.active_prop = active
@@ -1,18 +1,23 @@
 import numpy as np
 from kivy.app import App
 from kivy.core.window import Window
-from kivy.properties import BooleanProperty, StringProperty
+from kivy.properties import BooleanProperty, StringProperty, OptionProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.label import Label
+from kivy.uix.popup import Popup
 from kivymd.uix.behaviors import HoverBehavior
-from kivy_garden.graph import Graph, LinePlot
-from scipy import signal
+from kivy_garden.graph import Graph, LinePlot, Plot
 from typing import Optional, Callable
-from custom_types import MeasurementsChunk
+from custom_types import MeasurementsChunk, MeasurementsRingBuffer
+from gui.decimation import MinMaxDecimator
+from processing.filter_bank import FilterBank, FilterSpec
+from processing.spectrum import SpectrumAnalyzer
 import asyncio
 from constants import FS
 
+_READOUT_FILTER = FilterSpec(order=5, cutoff=2.0)
+
 
 class CustomButton(Button, HoverBehavior):
     active = BooleanProperty(False)
@@ -65,6 +70,14 @@ class InfoBar(Label):
         self.color = color
 
 
+class DiagnosticsPopup(Popup):
+    text = StringProperty('')
+
+    def __init__(self, text: str, **kwargs):
+        super(DiagnosticsPopup, self).__init__(**kwargs)
+        self.text = text
+
+
 class FilteredMeasurements(BoxLayout):
     x_text = StringProperty('')
     y_text = StringProperty('')
@@ -73,9 +86,6 @@ class FilteredMeasurements(BoxLayout):
 
     def __init__(self, **kwargs):
         super(FilteredMeasurements, self).__init__(**kwargs)
-        self._x_filt_state = None
-        self._y_filt_state = None
-        self._z_filt_state = None
         self.font_name = 'Cour'
         self._next_update_time: Optional[int] = None
         self.reset()
@@ -87,14 +97,14 @@ class FilteredMeasurements(BoxLayout):
         # self._zmax = -100.0
         # self._zmin = 100.0
 
+    def attach_filter_bank(self, filter_bank: FilterBank) -> None:
+        filter_bank.subscribe(_READOUT_FILTER, self.update)
+
     def reset(self):
         self._next_update_time = 0.0
-        self._update_filters()
 
-    def update(self, chunk: MeasurementsChunk) -> None:
-        x, self._x_filt_state = signal.sosfilt(self._aafilter, chunk.x, zi=self._x_filt_state)
-        y, self._y_filt_state = signal.sosfilt(self._aafilter, chunk.y, zi=self._y_filt_state)
-        z, self._z_filt_state = signal.sosfilt(self._aafilter, chunk.z, zi=self._z_filt_state)
+    def update(self, chunk: MeasurementsChunk, filtered: np.ndarray) -> None:
+        x, y, z = filtered
 
         # if min(x) < self._xmin:
         #     self._xmin = min(x)
@@ -109,7 +119,7 @@ class FilteredMeasurements(BoxLayout):
         # if max(z) > self._zmax:
         #     self._zmax = max(z)
 
-        if chunk.t[-1] > self._next_update_time:
+        if (chunk.stop_index - 1) / chunk.fs > self._next_update_time:
             self._next_update_time += 0.2
             m = np.sqrt(x[-1] ** 2 + y[-1] ** 2 + z[-1] ** 2)
             self.x_text = f"  Bx:{x[-1]:7.2f} mT"
@@ -119,38 +129,59 @@ class FilteredMeasurements(BoxLayout):
 
             # print(f" x_off: {(self._xmin + self._xmax)/2}, y_off: {(self._ymin + self._ymax) / 2}, z_off: {(self._zmin + self._zmax) / 2}")
 
-    def _update_filters(self):
-        self._aafilter = signal.iirfilter(N=5, Wn=2,
-                                          btype='low', ftype='butter', output='sos', fs=FS)
 
-        self._x_filt_state = np.zeros((self._aafilter.shape[0], 2))
-        self._y_filt_state = np.zeros((self._aafilter.shape[0], 2))
-        self._z_filt_state = np.zeros((self._aafilter.shape[0], 2))
+def _magnitude(xyz: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.einsum('ij,ij->j', xyz, xyz))
+
+
+class ArrayLinePlot(LinePlot):
+    """ LinePlot taking its vertices as numpy arrays, converted to pixel coordinates in one vectorized pass. """
+
+    def __init__(self, **kwargs):
+        super(ArrayLinePlot, self).__init__(**kwargs)
+        self._t = np.empty(0)
+        self._values = np.empty(0)
+
+    def set_data(self, t: np.ndarray, values: np.ndarray) -> None:
+        """ Arrays are not copied, they must stay unchanged until the next draw. """
+        self._t = t
+        self._values = values
+        self.ask_draw()
+
+    def draw(self, *args):
+        Plot.draw(self, *args)
+        vertices = np.empty(2 * len(self._t))
+        vertices[0::2] = self.x_px()(self._t)
+        vertices[1::2] = self.y_px()(self._values)
+        self._gline.points = vertices.tolist()
 
 
 class CustomGraph(Graph):
+    decimation_mode = OptionProperty('minmax', options=['minmax', 'lowpass'])
 
     def __init__(self, **kwargs):
         super(CustomGraph, self).__init__(**kwargs)
         self._MAX_PLOT_POINTS = 1000
         self._time_range = 10.0
-
-        self._x_filt_state: Optional = None
-        self._y_filt_state: Optional = None
-        self._z_filt_state: Optional = None
+        self._plot_points = self._MAX_PLOT_POINTS
+        self._decimator: Optional[MinMaxDecimator] = None
+        self._filter_bank: Optional[FilterBank] = None
+        self._filter_spec: Optional[FilterSpec] = None
         self._show_x: bool = True
         self._show_y: bool = True
         self._show_z: bool = True
         self._show_abs: bool = True
-        self._data_decimated: Optional[MeasurementsChunk] = None
-        self._x_plot: Optional[LinePlot] = LinePlot(color=[1, .1, 0, 1])
-        self._y_plot: Optional[LinePlot] = LinePlot(color=[.3, 1, 0, 1])
-        self._z_plot: Optional[LinePlot] = LinePlot(color=[0, 0.4, 1, 1])
-        self._abs_plot: Optional[LinePlot] = LinePlot(color=[1, 1, 1, 1])
+        # channels: t, x, y, z, |B|; decimated points are not evenly spaced, so t is stored
+        self._data_decimated = MeasurementsRingBuffer(self._history_size(), dtype=float, channels=5)
+        self._x_plot = ArrayLinePlot(color=[1, .1, 0, 1])
+        self._y_plot = ArrayLinePlot(color=[.3, 1, 0, 1])
+        self._z_plot = ArrayLinePlot(color=[0, 0.4, 1, 1])
+        self._abs_plot = ArrayLinePlot(color=[1, 1, 1, 1])
         self.add_plot(self._x_plot)
         self.add_plot(self._y_plot)
         self.add_plot(self._z_plot)
         self.add_plot(self._abs_plot)
+        self.bind(view_size=self._on_view_size)
         self.reset()
 
     def on_touch_down(self, touch):
@@ -171,64 +202,105 @@ class CustomGraph(Graph):
                     self.ymin -= 5.0
             self.y_ticks_major = (self.ymax - self.ymin) / 10.0
 
-    def _update_aafilter(self):
-        _MIN_SIN_SAMPLES = 3
-        self._aafilter = signal.iirfilter(N=8, Wn=(self._MAX_PLOT_POINTS / self._time_range) / _MIN_SIN_SAMPLES,
-                                          btype='low', ftype='butter', output='sos', fs=FS)
-
-        self._x_filt_state = np.zeros((self._aafilter.shape[0], 2))
-        self._y_filt_state = np.zeros((self._aafilter.shape[0], 2))
-        self._z_filt_state = np.zeros((self._aafilter.shape[0], 2))
+    def _history_size(self) -> int:
+        # min/max decimation yields two points per plot point
+        return int(2 * self._plot_points * 1.5)
 
-    def update_data(self, chunk: MeasurementsChunk):
+    def _on_view_size(self, instance, view_size):
+        plot_points = int(view_size[0]) if view_size[0] > 0 else self._MAX_PLOT_POINTS
+        if plot_points != self._plot_points:
+            self._plot_points = plot_points
+            _, history = self._data_decimated.last_columns()
+            self._data_decimated = MeasurementsRingBuffer(self._history_size(), dtype=float, channels=5)
+            self._data_decimated.extend_columns(history)
+            self._update_decimation()
 
-        filtered_chunk = MeasurementsChunk(x=[], y=[], z=[], t=chunk.t)
-        filtered_chunk.x, self._x_filt_state = signal.sosfilt(self._aafilter, chunk.x, zi=self._x_filt_state)
-        filtered_chunk.y, self._y_filt_state = signal.sosfilt(self._aafilter, chunk.y, zi=self._y_filt_state)
-        filtered_chunk.z, self._z_filt_state = signal.sosfilt(self._aafilter, chunk.z, zi=self._z_filt_state)
+    def attach_filter_bank(self, filter_bank: FilterBank) -> None:
+        self._filter_bank = filter_bank
+        self._filter_bank.subscribe(self._filter_spec, self.update_data)
 
-        q = int(FS * self._time_range / self._MAX_PLOT_POINTS)
-        decimated_chunk = MeasurementsChunk([], [], [], [])
-        decimated_chunk.t = [filtered_chunk.t[i] for i in range(0, len(filtered_chunk.t), q)]
-        decimated_chunk.x = [filtered_chunk.x[i] for i in range(0, len(filtered_chunk.x), q)]
-        decimated_chunk.y = [filtered_chunk.y[i] for i in range(0, len(filtered_chunk.y), q)]
-        decimated_chunk.z = [filtered_chunk.z[i] for i in range(0, len(filtered_chunk.z), q)]
-        self._data_decimated.extend(decimated_chunk)
-        self._data_decimated.drop_older_than(int(self._MAX_PLOT_POINTS * 1.5))
+    def _update_decimation(self):
+        _MIN_SIN_SAMPLES = 3
+        self._decimator = MinMaxDecimator(int(FS * self._time_range / self._plot_points))
+        self._filter_spec = FilterSpec(order=8, cutoff=(self._plot_points / self._time_range) / _MIN_SIN_SAMPLES) \
+            if self.decimation_mode == 'lowpass' else None
+        if self._filter_bank:
+            self._filter_bank.unsubscribe(self.update_data)
+            self._filter_bank.subscribe(self._filter_spec, self.update_data)
+
+    def update_data(self, chunk: MeasurementsChunk, xyz: np.ndarray):
+        """ Decimates the new chunk, given as 3xN x, y, z (low-pass filtered in 'lowpass' mode), and appends it with
+        its |B| to the plot history. """
+        if self.decimation_mode == 'minmax':
+            t, values = self._decimator.process(chunk.t, np.vstack((xyz, _magnitude(xyz))))
+        else:
+            q = self._decimator.bucket_size
+            t = chunk.t[::q]
+            values = np.vstack((xyz[:, ::q], _magnitude(xyz[:, ::q])))
+        self._data_decimated.extend_columns(np.vstack((t, values)))
 
     def update_plot(self):
-        if self._data_decimated.t[-1] > self.xmax:
+        _, history = self._data_decimated.last_columns()
+        t, values = history[0], history[1:]
+        if not len(t):
+            return
+        if t[-1] > self.xmax:
             self.xmax += self._time_range * 0.8
             self.xmin += self._time_range * 0.8
 
-        s = next(x for x, val in enumerate(self._data_decimated.t) if val >= self.xmin)
-        try:
-            if self._show_x:
-                self._x_plot.points = [(self._data_decimated.t[i], self._data_decimated.x[i]) for i in
-                                       range(len(self._data_decimated.t))]
-            if self._show_y:
-                self._y_plot.points = [(self._data_decimated.t[i], self._data_decimated.y[i]) for i in
-                                       range(len(self._data_decimated.t))]
-            if self._show_z:
-                self._z_plot.points = [(self._data_decimated.t[i], self._data_decimated.z[i]) for i in
-                                       range(len(self._data_decimated.t))]
-            if self._show_abs:
-                self._abs_plot.points = [(self._data_decimated.t[i], np.sqrt(self._data_decimated.x[i] ** 2 +
-                                                                             self._data_decimated.y[i] ** 2 +
-                                                                             self._data_decimated.z[i] ** 2)) for i in
-                                         range(len(self._data_decimated.t))]
-        except IndexError:
-            print("XD")
+        # plots keep views of the history, they are drawn before the next update_data modifies it
+        s = int(np.searchsorted(t, self.xmin))
+        for plot, shown, channel in ((self._x_plot, self._show_x, 0), (self._y_plot, self._show_y, 1),
+                                     (self._z_plot, self._show_z, 2), (self._abs_plot, self._show_abs, 3)):
+            if shown:
+                plot.set_data(t[s:], values[channel, s:])
 
     def reset(self):
         self.xmax = self._time_range
         self.xmin = self.xmax - self._time_range
-        self._data: MeasurementsChunk = MeasurementsChunk([], [], [], [])
-        self._data_decimated: MeasurementsChunk = MeasurementsChunk([], [], [], [])
-        self._x_plot.points = []
-        self._y_plot.points = []
-        self._z_plot.points = []
-        self._update_aafilter()
+        self._data_decimated.clear()
+        for plot in (self._x_plot, self._y_plot, self._z_plot, self._abs_plot):
+            plot.set_data(np.empty(0), np.empty(0))
+        self._update_decimation()
+
+
+class SpectrumGraph(Graph):
+    """ Live Welch PSD of x, y and z in dB re 1 mT^2/Hz. Spectra are computed by a SpectrumAnalyzer on its own thread,
+    update_plot() only picks up the newest one. """
+
+    def __init__(self, **kwargs):
+        super(SpectrumGraph, self).__init__(**kwargs)
+        self._analyzer = SpectrumAnalyzer()
+        self._version = 0
+        self._show_x: bool = True
+        self._show_y: bool = True
+        self._show_z: bool = True
+        self._x_plot = ArrayLinePlot(color=[1, .1, 0, 1])
+        self._y_plot = ArrayLinePlot(color=[.3, 1, 0, 1])
+        self._z_plot = ArrayLinePlot(color=[0, 0.4, 1, 1])
+        self.add_plot(self._x_plot)
+        self.add_plot(self._y_plot)
+        self.add_plot(self._z_plot)
+
+    def attach_filter_bank(self, filter_bank: FilterBank) -> None:
+        filter_bank.subscribe(None, self._analyzer.submit)
+
+    def update_plot(self):
+        version, psd = self._analyzer.latest()
+        if version == self._version:
+            return
+        self._version = version
+        if psd is None:
+            f, psd_db = np.empty(0), np.empty((3, 0))
+        else:
+            f, psd_db = self._analyzer.frequencies, 10 * np.log10(np.maximum(psd, 1e-30))
+        for plot, shown, channel in ((self._x_plot, self._show_x, 0), (self._y_plot, self._show_y, 1),
+                                     (self._z_plot, self._show_z, 2)):
+            if shown:
+                plot.set_data(f, psd_db[channel])
+
+    def reset(self):
+        self._analyzer.reset()
 
 
 class GuiLayout(BoxLayout):
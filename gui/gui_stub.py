@@ -1,39 +1,71 @@
-from interfaces.i_gui_controller import IGuiController
+from interfaces.i_gui_controller import IGuiController, SensorRange
 from interfaces.i_gui_subject import IGuiSubject
 from interfaces.i_gui_observer import IGuiObserver
-import asyncio
-from custom_types import Vector
-from typing import List, Optional
+from custom_types import MeasurementsChunk
+from diagnostics.latency_tracer import LatencyTracer
+from typing import Optional
 import logging
-from aioconsole import ainput
 
 logger = logging.getLogger(__name__)
 
 
 class GuiStub(IGuiController, IGuiSubject):
+    """ GUI without any rendering: state changes are logged, measurements are dropped. Latency traces are completed
+    on arrival, so they cover the pipeline up to the dequeue stage. """
 
-    def __init__(self):
+    def __init__(self, tracer: Optional[LatencyTracer] = None):
         self._gui_observer: Optional[IGuiObserver] = None
+        self._tracer = tracer
 
-    def update_measurement_text_field(self, measurement: Vector) -> None:
-        logger.info(f"Text fields updated with {measurement}")
+    def update_measurements(self, measurements: MeasurementsChunk) -> None:
+        if self._tracer:
+            self._tracer.complete(measurements.traces)
 
-    def update_graph(self, measurements: List[Vector]) -> None:
-        logger.info(f"Graph updated with {measurements}")
+    def reset_measurement_text_field(self) -> None:
+        pass
 
-    def set_waiting_for_connection_message(self, shown: bool) -> None:
-        logger.info(f"Waiting for connection message {'shown' if shown else 'hidden'}")
+    def reset_graph(self) -> None:
+        pass
+
+    def show_info(self, text: str, warning: bool = False) -> None:
+        if warning:
+            logger.warning(text)
+        else:
+            logger.info(text)
+
+    def show_diagnostics(self, text: str) -> None:
+        logger.info(text)
 
     def set_start_button_active(self, active: bool) -> None:
-        logger.info(f"Start button set {'active' if active else 'inactive'}")
+        logger.debug(f"Start button set {'active' if active else 'inactive'}")
+
+    def set_record_button_active(self, active: bool) -> None:
+        logger.debug(f"Record button set {'active' if active else 'inactive'}")
 
     def set_stop_button_active(self, active: bool) -> None:
-        logger.info(f"Stop button set {'active' if active else 'inactive'}")
+        logger.debug(f"Stop button set {'active' if active else 'inactive'}")
+
+    def set_range_buttons_active(self, active: bool) -> None:
+        logger.debug(f"Range buttons set {'active' if active else 'inactive'}")
+
+    def highlight_range_button(self, range: SensorRange) -> None:
+        logger.debug(f"Range {range.to_float()} mT highlighted")
+
+    def set_explore_data_button(self, active: bool) -> None:
+        logger.debug(f"Explore data button set {'active' if active else 'inactive'}")
+
+    def set_save_data_button(self, active: bool) -> None:
+        logger.debug(f"Save data button set {'active' if active else 'inactive'}")
+
+    def set_cancel_export_button(self, active: bool) -> None:
+        logger.debug(f"Cancel export button set {'active' if active else 'inactive'}")
 
     def attach_observer(self, observer: IGuiObserver) -> None:
         self._gui_observer = observer
 
     async def run(self):
+        from aioconsole import ainput
+
         while True:
             # i = await ainput("s: click start, p: click pause, q: click configure 25mt, w: click configure 50mt, "
             #                  "e: click configure 100mt")
@@ -49,5 +81,9 @@ class GuiStub(IGuiController, IGuiSubject):
                     self._gui_observer.on_50_mt_range_button()
                 elif i == 'e':
                     self._gui_observer.on_100_mt_range_button()
+                elif i == 'd':
+                    self._gui_observer.on_diagnostics_button()
+                elif i == 'c':
+                    self._gui_observer.on_cancel_export_button()
                 elif i == 'x':
                     return
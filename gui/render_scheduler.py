@@ -0,0 +1,53 @@
+from typing import Callable, List
+
+from kivy.clock import Clock
+
+from custom_types import MeasurementsChunk
+
+
+class RenderScheduler:
+    """ Decouples rendering from acquisition: chunks submitted between frames are accumulated and rendered together
+    once per frame, driven by the Kivy clock.
+
+    submit() only stores the chunk, so the acquisition loop never waits for rendering. When a frame comes late, the
+    frames in between are skipped rather than caught up, and counted. Chunks are joined only where they follow each
+    other, runs after a gap in the sample indices, e.g. of dropped chunks, are rendered separately. """
+
+    def __init__(self, render: Callable[[MeasurementsChunk], None], fps: float):
+        self._render = render
+        self._period = 1.0 / fps
+        self._pending: List[MeasurementsChunk] = []
+        self._rendered_frames = 0
+        self._skipped_frames = 0
+        self._event = Clock.schedule_interval(self._on_frame, self._period)
+
+    @property
+    def rendered_frames(self) -> int:
+        return self._rendered_frames
+
+    @property
+    def skipped_frames(self) -> int:
+        return self._skipped_frames
+
+    def set_fps(self, fps: float) -> None:
+        self._event.cancel()
+        self._period = 1.0 / fps
+        self._event = Clock.schedule_interval(self._on_frame, self._period)
+
+    def submit(self, chunk: MeasurementsChunk) -> None:
+        self._pending.append(chunk)
+
+    def clear(self) -> None:
+        """ Drops pending chunks and starts counting frames from zero. """
+        self._pending = []
+        self._rendered_frames = 0
+        self._skipped_frames = 0
+
+    def _on_frame(self, dt: float) -> None:
+        self._skipped_frames += max(0, int(dt / self._period) - 1)
+        if not self._pending:
+            return
+        chunks, self._pending = self._pending, []
+        for chunk in MeasurementsChunk.join_contiguous(chunks):
+            self._render(chunk)
+        self._rendered_frames += 1
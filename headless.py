@@ -0,0 +1,142 @@
+from sensor.sensor import Sensor
+from sensor.probe_array import ProbeArray
+from sensor.process_sensor import ProcessSensor
+from sensor.ftd2xx_emulator import EmulatedDriver
+from gui.gui_stub import GuiStub
+from supervisor.supervisor import Supervisor, AppState
+from sensor.sync_async_queue import OverflowPolicy
+from diagnostics.latency_tracer import LatencyTracer
+from constants import FS
+from time import perf_counter
+from functools import partial
+import argparse
+import asyncio
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+_CONNECT_TIMEOUT = 10.0
+_STATE_POLL_PERIOD = 0.1
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Acquire magnetometer data without the GUI.')
+    parser.add_argument('-d', '--duration', type=float, required=True, help='acquisition time [s]')
+    parser.add_argument('-r', '--range', type=int, choices=[25, 50, 100], default=50, help='sensor range [mT]')
+    parser.add_argument('-o', '--output', help='recording file, .mag for a session file, CSV otherwise; '
+                                               'if omitted data is only counted')
+    parser.add_argument('-s', '--serial', action='append',
+                        help='serial number of a probe to acquire from, may be repeated for multiple probes')
+    parser.add_argument('-a', '--all-probes', action='store_true', help='acquire from all connected probes')
+    parser.add_argument('-p', '--acquisition-process', action='store_true',
+                        help='read and decode in a separate process (single probe only)')
+    parser.add_argument('--raw-counts', action='store_true',
+                        help='store raw ADC counts with their calibration in .mag files instead of mT')
+    parser.add_argument('--poll', type=float, metavar='RATE',
+                        help='poll single readings at RATE [1/s] instead of streaming (single probe only)')
+    parser.add_argument('--emulate', action='store_true', help='use an emulated probe instead of a real one')
+    parser.add_argument('--emulated-probes', type=int, default=1, help='number of emulated probes')
+    parser.add_argument('--emulated-rate', type=float, default=FS, help='sample rate of the emulated probe [S/s]')
+    parser.add_argument('--emulated-jitter', type=float, default=0.0, help='packet jitter of the emulated probe [s]')
+    parser.add_argument('--emulated-stalls', type=float, default=0.0,
+                        help='probability of a USB stall per packet of the emulated probe')
+    parser.add_argument('--overflow-policy', choices=[policy.value for policy in OverflowPolicy],
+                        default=OverflowPolicy.COALESCE.value,
+                        help='handling of chunks arriving while the measurement queue is full')
+    parser.add_argument('--max-pending-chunks', type=int, default=256, help='size of the measurement queue')
+    parser.add_argument('--latency-timer', type=int, default=2, help='FTDI latency timer [ms]')
+    parser.add_argument('--usb-transfer-size', type=int, default=16384, help='FTDI USB transfer size [B]')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+
+async def _wait_for_state(supervisor: Supervisor, state: AppState, timeout: float) -> None:
+    async def wait():
+        while supervisor.app_state != state:
+            await asyncio.sleep(_STATE_POLL_PERIOD)
+    await asyncio.wait_for(wait(), timeout)
+
+
+async def _poll(sensor: Sensor, rate: float, duration: float) -> None:
+    if not isinstance(sensor, Sensor):
+        logger.error("Polling needs a single probe read in this process")
+        sys.exit(1)
+    readings = 0
+    reading = None
+    await sensor.start_polling(rate)
+    start = perf_counter()
+    while perf_counter() - start < duration:
+        reading = await sensor.read()
+        readings += 1
+        logger.debug(f"Reading {reading}")
+    elapsed = perf_counter() - start
+    await sensor.stop_polling()
+    logger.info(f"Polled {readings} readings in {elapsed:.2f} s: {readings / elapsed:.1f} readings/s, last {reading}")
+
+
+async def main(args: argparse.Namespace):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    tracer = LatencyTracer()
+    gui = GuiStub(tracer=tracer)
+    driver_factory = partial(EmulatedDriver, fs=args.emulated_rate, jitter=args.emulated_jitter,
+                             stall_probability=args.emulated_stalls,
+                             serials=[f'EMU{i:05d}'.encode() for i in range(args.emulated_probes)]) \
+        if args.emulate else None
+    sensor_options = dict(latency_timer=args.latency_timer, usb_transfer_size=args.usb_transfer_size)
+    serials = [serial.encode() for serial in args.serial] if args.serial else None
+    driver = driver_factory() if driver_factory else None
+    if args.all_probes or (serials and len(serials) > 1):
+        sensor = ProbeArray(driver, serials, tracer, **sensor_options)
+    elif args.acquisition_process:
+        sensor = ProcessSensor(driver_factory, tracer, serial=serials[0] if serials else None, **sensor_options)
+    else:
+        sensor = Sensor(driver, tracer, serial=serials[0] if serials else None, **sensor_options)
+    supervisor = Supervisor(gui_controller=gui, sensor_controller=sensor, tracer=tracer,
+                            overflow_policy=OverflowPolicy(args.overflow_policy),
+                            max_pending_chunks=args.max_pending_chunks, raw_counts=args.raw_counts)
+    gui.attach_observer(supervisor)
+    sensor.attach_consumer(supervisor)
+
+    try:
+        await _wait_for_state(supervisor, AppState.STANDBY, _CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Sensor not connected")
+        sys.exit(1)
+
+    {25: supervisor.on_25_mt_range_button,
+     50: supervisor.on_50_mt_range_button,
+     100: supervisor.on_100_mt_range_button}[args.range]()
+    try:
+        await _wait_for_state(supervisor, AppState.STANDBY, _CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Sensor range not set")
+        sys.exit(1)
+
+    if args.poll:
+        await _poll(sensor, args.poll, args.duration)
+        return
+
+    if args.output:
+        supervisor.start_recording(args.output)
+    else:
+        supervisor.on_start_button()
+    start = perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = perf_counter() - start
+    await supervisor.stop()
+
+    samples = supervisor.samples_received
+    nominal_rate = args.emulated_rate if args.emulate else FS
+    logger.info(f"Acquired {samples} samples in {elapsed:.2f} s: {samples / elapsed:.0f} S/s "
+                f"(nominal {nominal_rate:.0f} S/s)")
+    supervisor.on_diagnostics_button()
+    if isinstance(sensor, ProcessSensor):
+        sensor.close()
+    if supervisor.app_state != AppState.STANDBY:
+        logger.error("Acquisition interrupted")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(_parse_args()))
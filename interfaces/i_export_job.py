@@ -0,0 +1,38 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+
+
+class IExportJob(ABC):
+
+    @property
+    @abstractmethod
+    def path(self) -> str:
+        pass
+
+    @property
+    @abstractmethod
+    def progress(self) -> float:
+        pass
+
+    @property
+    @abstractmethod
+    def done(self) -> bool:
+        pass
+
+    @property
+    @abstractmethod
+    def cancelled(self) -> bool:
+        pass
+
+    @property
+    @abstractmethod
+    def error(self) -> Optional[Exception]:
+        pass
+
+    @abstractmethod
+    def cancel(self) -> None:
+        pass
+
+    @abstractmethod
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        pass
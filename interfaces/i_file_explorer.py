@@ -5,5 +5,5 @@ class IFileExplorer(ABC):
 
     @staticmethod
     @abstractmethod
-    def explore_file() -> None:
+    def explore_file(float32: bool = True) -> None:
         pass
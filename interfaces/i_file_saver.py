@@ -1,10 +1,13 @@
 from abc import ABC, abstractmethod
-from custom_types import MeasurementsChunk
+from custom_types import MeasurementsChunk, SessionInfo
+from interfaces.i_export_job import IExportJob
+from typing import Optional
 
 
 class IFileSaver(ABC):
 
     @staticmethod
     @abstractmethod
-    def save_to_file(measurements: MeasurementsChunk) -> None:
+    def save_to_file(measurements: MeasurementsChunk, info: SessionInfo,
+                     raw_counts: bool = False) -> Optional[IExportJob]:
         pass
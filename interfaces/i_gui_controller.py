@@ -6,7 +6,8 @@ from interfaces.i_sensor_controller import SensorRange
 class IGuiController(ABC):
 
     @abstractmethod
-    def update_measurement_text_field(self, measurements: MeasurementsChunk) -> None:
+    def update_measurements(self, measurements: MeasurementsChunk) -> None:
+        """ Passes new measurements to all displays: the numeric readout and the graph. """
         pass
 
     @abstractmethod
@@ -14,21 +15,26 @@ class IGuiController(ABC):
         pass
 
     @abstractmethod
-    def update_graph(self, measurements: MeasurementsChunk) -> None:
+    def reset_graph(self) -> None:
         pass
 
     @abstractmethod
-    def reset_graph(self) -> None:
+    def show_info(self, text: str, warning: bool = False) -> None:
         pass
 
     @abstractmethod
-    def show_info(self, text: str, warning: bool = False) -> None:
+    def show_diagnostics(self, text: str) -> None:
+        """ Shows a multi-line report, e.g. latency statistics. """
         pass
 
     @abstractmethod
     def set_start_button_active(self, active: bool) -> None:
         pass
 
+    @abstractmethod
+    def set_record_button_active(self, active: bool) -> None:
+        pass
+
     @abstractmethod
     def set_stop_button_active(self, active: bool) -> None:
         pass
@@ -48,3 +54,7 @@ class IGuiController(ABC):
     @abstractmethod
     def set_save_data_button(self, active: bool) -> None:
         pass
+
+    @abstractmethod
+    def set_cancel_export_button(self, active: bool) -> None:
+        pass
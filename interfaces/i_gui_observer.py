@@ -7,6 +7,10 @@ class IGuiObserver(ABC):
     def on_start_button(self) -> None:
         pass
 
+    @abstractmethod
+    def on_record_button(self) -> None:
+        pass
+
     @abstractmethod
     def on_stop_button(self) -> None:
         pass
@@ -31,4 +35,12 @@ class IGuiObserver(ABC):
     def on_save_data_button(self) -> None:
         pass
 
+    @abstractmethod
+    def on_cancel_export_button(self) -> None:
+        pass
+
+    @abstractmethod
+    def on_diagnostics_button(self) -> None:
+        pass
+
     
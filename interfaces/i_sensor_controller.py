@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from custom_types import Vector
+from custom_types import Vector, StreamStatistics
+from typing import List
 from enum import IntEnum
 
 
@@ -18,28 +19,55 @@ class SensorCommunicationError(Exception):
     pass
 
 class ISensorController(ABC):
+    """ Control calls are coroutines, exchanging messages with the probe without blocking the event loop. They raise
+    SensorCommunicationError when the probe does not respond in time. """
 
     @abstractmethod
-    def connect_and_init(self) -> bool:
+    async def connect_and_init(self) -> None:
         pass
 
     @abstractmethod
-    def reconfigure(self, sensor_range: SensorRange) -> None:
+    async def reconfigure(self, sensor_range: SensorRange) -> None:
         pass
 
     @abstractmethod
     async def read(self) -> Vector:
+        """ Single reading [mT], taken outside of a stream. """
         pass
 
     @abstractmethod
-    def start_stream(self) -> None:
+    async def start_stream(self) -> None:
         pass
 
     @abstractmethod
-    def stop_stream(self) -> None:
+    async def stop_stream(self) -> None:
         """ It is guaranteed that sensor will not stream more readings after this coroutine completes. """
         pass
 
     @abstractmethod
     def get_current_range(self) -> SensorRange:
         pass
+
+    @abstractmethod
+    def get_probe_count(self) -> int:
+        """ Number of probes acquired together, chunks carry the further ones in MeasurementsChunk.probes. """
+        pass
+
+    @abstractmethod
+    def get_offsets(self) -> Vector:
+        """ Calibration offsets [mT] subtracted from readings in the current range. """
+        pass
+
+    @abstractmethod
+    def get_probe_ranges(self) -> List[SensorRange]:
+        """ Current range of every probe, the first one being get_current_range(). """
+        pass
+
+    @abstractmethod
+    def get_probe_offsets(self) -> List[Vector]:
+        """ Calibration offsets [mT] of every probe in its current range, the first ones being get_offsets(). """
+        pass
+
+    @abstractmethod
+    def get_stream_statistics(self) -> StreamStatistics:
+        pass
@@ -1,23 +1,33 @@
-from sensor.sensor_stub import SensorStub
 from sensor.sensor import Sensor
-from gui.gui_stub import GuiStub
+from sensor.process_sensor import ProcessSensor
 from gui.gui import Gui
 from supervisor.supervisor import Supervisor
+from diagnostics.latency_tracer import LatencyTracer
 import asyncio
 import logging
+import os
+
+# set to 1 to read and decode the probe stream in a separate process, isolated from rendering
+_ACQUISITION_PROCESS_VARIABLE = 'MAGNETOMETER_ACQUISITION_PROCESS'
 
 
 async def main():
     logging.basicConfig(level=logging.INFO)
-    gui = Gui()
+    tracer = LatencyTracer()
+    gui = Gui(tracer=tracer)
     await gui.wait_until_initialized()
-    sensor = Sensor()
-    supervisor = Supervisor(gui_controller=gui, sensor_controller=sensor)
+    sensor = ProcessSensor(tracer=tracer) if os.environ.get(_ACQUISITION_PROCESS_VARIABLE) == '1' \
+        else Sensor(tracer=tracer)
+    supervisor = Supervisor(gui_controller=gui, sensor_controller=sensor, tracer=tracer)
     gui.attach_observer(supervisor)
     sensor.attach_consumer(supervisor)
 
     await gui.wait_for_closed()
-    supervisor.on_stop_button()
+    await supervisor.stop()
+    await supervisor.wait_for_exports()
+    if isinstance(sensor, ProcessSensor):
+        sensor.close()
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
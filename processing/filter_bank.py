@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from scipy import signal
+
+from constants import FS
+from custom_types import MeasurementsChunk
+
+FilterConsumer = Callable[[MeasurementsChunk, np.ndarray], None]
+
+
+@dataclass(frozen=True)
+class FilterSpec:
+    order: int
+    cutoff: float
+    btype: str = 'low'
+
+
+@lru_cache(maxsize=None)
+def design_filter(spec: FilterSpec, fs: float = FS) -> np.ndarray:
+    """ Butterworth filter in second order sections, designed once per spec and sampling frequency. """
+    return signal.iirfilter(N=spec.order, Wn=spec.cutoff, btype=spec.btype, ftype='butter', output='sos', fs=fs)
+
+
+class FilterBank:
+    """ Filters incoming measurements for any number of consumers.
+
+    x, y and z are filtered together as one 3xN array, once per distinct FilterSpec no matter how many consumers
+    subscribed to it. Consumers subscribed with None get the unfiltered 3xN array. """
+
+    def __init__(self, fs: float = FS):
+        self._fs = fs
+        self._consumers: Dict[Optional[FilterSpec], List[FilterConsumer]] = {}
+        self._states: Dict[FilterSpec, np.ndarray] = {}
+
+    def subscribe(self, spec: Optional[FilterSpec], consumer: FilterConsumer) -> None:
+        self._consumers.setdefault(spec, []).append(consumer)
+        if spec is not None and spec not in self._states:
+            self._states[spec] = self._initial_state(spec)
+
+    def unsubscribe(self, consumer: FilterConsumer) -> None:
+        for spec, consumers in list(self._consumers.items()):
+            if consumer in consumers:
+                consumers.remove(consumer)
+            if not consumers:
+                del self._consumers[spec]
+                self._states.pop(spec, None)
+
+    def reset(self) -> None:
+        for spec in self._states:
+            self._states[spec] = self._initial_state(spec)
+
+    def process(self, chunk: MeasurementsChunk) -> None:
+        xyz = np.vstack((chunk.x, chunk.y, chunk.z))
+        for spec, consumers in list(self._consumers.items()):
+            if spec is None:
+                filtered = xyz
+            else:
+                filtered, self._states[spec] = signal.sosfilt(design_filter(spec, self._fs), xyz, axis=1,
+                                                              zi=self._states[spec])
+            for consumer in list(consumers):
+                consumer(chunk, filtered)
+
+    def _initial_state(self, spec: FilterSpec) -> np.ndarray:
+        return np.zeros((design_filter(spec, self._fs).shape[0], 3, 2))
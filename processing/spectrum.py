@@ -0,0 +1,147 @@
+import queue
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import fft, signal
+
+from constants import FS
+from custom_types import MeasurementsChunk
+
+# 1 s segments, 1 Hz resolution
+_DEFAULT_SEGMENT_SIZE = int(FS)
+_DEFAULT_AVERAGES = 10
+_MAX_PENDING_CHUNKS = 64
+_RESET = object()
+
+
+class WelchAccumulator:
+    """ Welch power spectral density [mT^2/Hz] of x, y and z, updated incrementally as samples arrive.
+
+    Samples are split into Hann windowed segments of segment_size samples overlapping by half, detrended and scaled
+    like scipy.signal.welch with its defaults. Only the segments completed by new samples are transformed, so the cost
+    per chunk does not depend on how long the spectrum has been accumulating. The PSD is the mean over the segments
+    so far, turning into an exponential average over about averages segments once that many were seen, so it follows
+    changes of the field. Samples not following the previous ones, e.g. after lost chunks, start new segments. """
+
+    def __init__(self, fs: float = FS, segment_size: int = _DEFAULT_SEGMENT_SIZE, averages: int = _DEFAULT_AVERAGES):
+        self._segment_size = segment_size
+        self._step = segment_size - segment_size // 2
+        self._averages = averages
+        self._window = signal.get_window('hann', segment_size)
+        self._frequencies = fft.rfftfreq(segment_size, 1 / fs)
+        # one-sided density: power of all bins but DC and Nyquist counted twice
+        self._scale = np.full(len(self._frequencies), 2.0 / (fs * np.sum(self._window ** 2)))
+        self._scale[0] /= 2
+        if segment_size % 2 == 0:
+            self._scale[-1] /= 2
+        self.reset()
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self._frequencies
+
+    @property
+    def psd(self) -> np.ndarray:
+        """ 3 x len(frequencies) PSD of x, y and z, updated in place. """
+        return self._psd
+
+    @property
+    def segments(self) -> int:
+        """ Number of segments averaged since the last reset. """
+        return self._segments
+
+    def reset(self) -> None:
+        self._pending = np.empty((3, 0))
+        self._stop_index: Optional[int] = None
+        self._psd = np.zeros((3, len(self._frequencies)))
+        self._segments = 0
+
+    def update(self, start_index: int, xyz: np.ndarray) -> bool:
+        """ Adds the 3xN samples starting at sample index start_index, returns True if the PSD changed. """
+        if start_index != self._stop_index:
+            self._pending = self._pending[:, :0]
+        self._stop_index = start_index + xyz.shape[1]
+        samples = np.hstack((self._pending, xyz))
+        count = (samples.shape[1] - self._segment_size) // self._step + 1
+        if count <= 0:
+            self._pending = samples
+            return False
+
+        segments = np.lib.stride_tricks.sliding_window_view(samples, self._segment_size, axis=1)[:, ::self._step]
+        segments = segments[:, :count]
+        segments = (segments - segments.mean(axis=2, keepdims=True)) * self._window
+        spectra = fft.rfft(segments, axis=2)
+        power = (spectra.real ** 2 + spectra.imag ** 2) * self._scale
+        for i in range(count):
+            self._segments += 1
+            self._psd += (power[:, i] - self._psd) / min(self._segments, self._averages)
+        self._pending = samples[:, count * self._step:]
+        return True
+
+
+class SpectrumAnalyzer:
+    """ Runs a WelchAccumulator on a worker thread, off the UI thread; scipy's FFT releases the GIL.
+
+    submit() has the signature of a FilterBank consumer and only queues the samples. Chunks arriving while
+    max_pending_chunks wait are dropped, and counted; the spectrum then restarts its segments after the gap. latest()
+    returns the newest PSD with a version number increasing with every update. """
+
+    def __init__(self, fs: float = FS, segment_size: int = _DEFAULT_SEGMENT_SIZE, averages: int = _DEFAULT_AVERAGES,
+                 max_pending_chunks: int = _MAX_PENDING_CHUNKS):
+        self._accumulator = WelchAccumulator(fs, segment_size, averages)
+        self._pending: queue.Queue = queue.Queue(max_pending_chunks)
+        self._lock = threading.Lock()
+        self._latest: Optional[np.ndarray] = None
+        self._version = 0
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._analyzer_task, name='spectrum-analyzer', daemon=True)
+        self._thread.start()
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self._accumulator.frequencies
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def submit(self, chunk: MeasurementsChunk, xyz: np.ndarray) -> None:
+        """ xyz, the 3xN samples of chunk, is not copied and must not be modified afterwards. """
+        try:
+            self._pending.put_nowait((chunk.start_index, xyz))
+        except queue.Full:
+            self._dropped += 1
+
+    def latest(self) -> Tuple[int, Optional[np.ndarray]]:
+        """ Returns the version and the 3 x len(frequencies) PSD of x, y and z, None before the first segment. """
+        with self._lock:
+            return self._version, self._latest
+
+    def reset(self) -> None:
+        """ Drops pending samples and the accumulated spectrum. """
+        try:
+            while True:
+                self._pending.get_nowait()
+        except queue.Empty:
+            pass
+        self._pending.put(_RESET)
+
+    def close(self) -> None:
+        self._pending.put(None)
+
+    def _analyzer_task(self) -> None:
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            if item is _RESET:
+                self._accumulator.reset()
+                psd = None
+            elif self._accumulator.update(*item):
+                psd = self._accumulator.psd.copy()
+            else:
+                continue
+            with self._lock:
+                self._latest = psd
+                self._version += 1
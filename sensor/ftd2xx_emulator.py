@@ -0,0 +1,186 @@
+import random
+import threading
+from time import perf_counter, sleep
+from typing import List, Optional
+
+import numpy as np
+
+from constants import FS
+from interfaces.i_sensor_controller import SensorRange
+from sensor.ftd_driver import DeviceError
+from sensor.packet_decoder import sensor_offsets, SAMPLE_SIZE
+from sensor.sensor import MessageType
+
+_PACKET_SAMPLES = 80
+_REGISTERS_COUNT = 20
+
+
+class EmulatedDriver:
+    """ Stands in for the ftd2xx module, providing listDevices(), open() and openEx() for emulated probes.
+
+    fs: streaming sample rate [S/s]
+    jitter: maximum random delay of every packet [s]
+    stall_probability: probability that a packet starts a USB stall, during which nothing is delivered
+    stall_duration: length of a stall [s], data produced meanwhile is delivered in one burst afterwards
+    disconnect_after: time from opening a device after which it disconnects [s], never if None """
+
+    def __init__(self, fs: float = FS, jitter: float = 0.0, stall_probability: float = 0.0,
+                 stall_duration: float = 0.05, disconnect_after: Optional[float] = None,
+                 serials: Optional[List[bytes]] = None, seed: Optional[int] = None):
+        self.fs = fs
+        self.jitter = jitter
+        self.stall_probability = stall_probability
+        self.stall_duration = stall_duration
+        self.disconnect_after = disconnect_after
+        self.serials = serials if serials is not None else [b'EMU00000']
+        self.random = random.Random(seed)
+        self._disconnected = False
+
+    def listDevices(self) -> Optional[List[bytes]]:
+        return None if self._disconnected or not self.serials else list(self.serials)
+
+    def open(self, index: int) -> 'EmulatedDevice':
+        if self._disconnected or index >= len(self.serials):
+            raise DeviceError('DEVICE_NOT_FOUND')
+        return EmulatedDevice(self, self.serials[index])
+
+    def openEx(self, serial: bytes) -> 'EmulatedDevice':
+        if self._disconnected or serial not in self.serials:
+            raise DeviceError('DEVICE_NOT_FOUND')
+        return EmulatedDevice(self, serial)
+
+    @property
+    def disconnected(self) -> bool:
+        return self._disconnected
+
+    def disconnect(self) -> None:
+        self._disconnected = True
+
+
+class EmulatedDevice:
+    """ Byte level emulation of the probe behind an FTD2XX device.
+
+    Requests are answered like the firmware does and, while streaming, 480 byte packets of big-endian int16 x, y, z
+    samples become readable at the configured rate. read() blocks until the requested number of bytes is available or
+    the read timeout expires, like the D2XX driver. """
+
+    def __init__(self, driver: EmulatedDriver, serial: bytes):
+        self._driver = driver
+        self._serial = serial
+        self._lock = threading.Lock()
+        self._rx = bytearray()
+        self._read_timeout = 1.0
+        self._opened_at = perf_counter()
+        self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+        self._streaming = False
+        self._stream_start = 0.0
+        self._packets_sent = 0
+        self._next_packet_time = 0.0
+        self._stall_until = 0.0
+        self._closed = False
+
+    def setBaudRate(self, baud: int) -> None:
+        self._check_connected()
+
+    def setTimeouts(self, read: int, write: int) -> None:
+        self._check_connected()
+        self._read_timeout = read / 1000.0
+
+    def setLatencyTimer(self, latency: int) -> None:
+        self._check_connected()
+
+    def setUSBParameters(self, in_transfer_size: int, out_transfer_size: int = 0) -> None:
+        self._check_connected()
+
+    def getDeviceInfo(self) -> dict:
+        return {'type': 8, 'id': 0, 'description': b'USB Magnetometer (emulated)', 'serial': self._serial}
+
+    def getQueueStatus(self) -> int:
+        with self._lock:
+            self._check_connected()
+            self._produce_packets(perf_counter())
+            return len(self._rx)
+
+    def purge(self, mask: int = 0) -> None:
+        with self._lock:
+            self._rx.clear()
+
+    def close(self) -> None:
+        self._closed = True
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            self._check_connected()
+            for i in range(0, len(data) - 1, 2):
+                self._handle_request(MessageType(data[i]), data[i + 1])
+            return len(data)
+
+    def read(self, size: int) -> bytes:
+        deadline = perf_counter() + self._read_timeout
+        while True:
+            with self._lock:
+                self._check_connected()
+                now = perf_counter()
+                self._produce_packets(now)
+                if len(self._rx) >= size or now >= deadline:
+                    result = bytes(self._rx[:size])
+                    del self._rx[:size]
+                    return result
+                wakeup = min(deadline, max(self._next_packet_time, self._stall_until)) if self._streaming \
+                    else deadline
+            sleep(max(0.0, wakeup - now))
+
+    def _check_connected(self) -> None:
+        if self._driver.disconnect_after is not None \
+                and perf_counter() - self._opened_at > self._driver.disconnect_after:
+            self._driver.disconnect()
+        if self._closed or self._driver.disconnected:
+            raise DeviceError('DEVICE_NOT_OPENED')
+
+    def _handle_request(self, message_type: MessageType, data: int) -> None:
+        if message_type == MessageType.GET_READING:
+            self._rx += bytes([message_type, 0]) + self._samples(perf_counter() - self._opened_at, 1).tobytes()
+        elif message_type == MessageType.READ_REGISTER:
+            self._rx += bytes([message_type, data % _REGISTERS_COUNT, 0, 0])
+        elif message_type == MessageType.START_STREAM:
+            self._rx += bytes([message_type, 0])
+            self._streaming = True
+            self._stream_start = perf_counter()
+            self._packets_sent = 0
+            self._next_packet_time = self._packet_time(0)
+        elif message_type == MessageType.STOP_STREAM:
+            self._streaming = False
+        else:
+            if message_type == MessageType.SET_RANGE:
+                self._sensor_range = SensorRange(data)
+            elif message_type == MessageType.RESET:
+                self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+            self._rx += bytes([message_type, 0])
+
+    def _packet_time(self, packet: int) -> float:
+        return self._stream_start + (packet + 1) * _PACKET_SAMPLES / self._driver.fs \
+            + self._driver.random.uniform(0.0, self._driver.jitter)
+
+    def _produce_packets(self, now: float) -> None:
+        if not self._streaming or now < self._stall_until:
+            return
+        while self._next_packet_time <= now:
+            t0 = self._packets_sent * _PACKET_SAMPLES / self._driver.fs
+            self._rx += self._samples(t0, _PACKET_SAMPLES).tobytes()
+            self._packets_sent += 1
+            self._next_packet_time = max(self._next_packet_time, self._packet_time(self._packets_sent))
+            if self._driver.random.random() < self._driver.stall_probability:
+                self._stall_until = now + self._driver.stall_duration
+                return
+
+    def _samples(self, t0: float, count: int) -> np.ndarray:
+        """ Raw big-endian counts of a slowly rotating field with 50 Hz mains interference. """
+        t = t0 + np.arange(count) / self._driver.fs
+        rotation = 2 * np.pi * 0.2 * t
+        mains = 0.5 * np.sin(2 * np.pi * 50.0 * t)
+        offsets = sensor_offsets(self._sensor_range)
+        field = np.vstack((10.0 * np.cos(rotation) + mains + offsets.x,
+                           10.0 * np.sin(rotation) + mains + offsets.y,
+                           np.full(count, 5.0) + mains + offsets.z))
+        counts = np.clip(np.round(field / self._sensor_range.to_float() * 2.0 ** 15), -2 ** 15, 2 ** 15 - 1)
+        return counts.T.astype('>i2').reshape(count * SAMPLE_SIZE // 2)
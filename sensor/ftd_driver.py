@@ -0,0 +1,31 @@
+""" ftd2xx needs the native FTDI D2XX library. Without it only emulated devices (sensor.ftd2xx_emulator) can be
+used. """
+import ctypes
+
+try:
+    import ftd2xx
+    from ftd2xx import DeviceError, FTD2XX
+    from ftd2xx import ftd2xx as _ftd2xx_module
+except (ImportError, OSError):
+    ftd2xx = None
+    FTD2XX = object
+    _ftd2xx_module = None
+
+    class DeviceError(Exception):
+        pass
+
+
+def read_into(device, buffer: memoryview) -> int:
+    """ Reads up to len(buffer) bytes into buffer, blocking like device.read(), and returns the number of bytes read.
+
+    D2XX devices read straight into the buffer with FT_Read, saving the allocation of a bytes object per read. Other
+    devices, e.g. emulated ones, fall back to read() and a copy. """
+    size = len(buffer)
+    if _ftd2xx_module is not None and isinstance(device, FTD2XX):
+        bytes_read = _ftd2xx_module._ft.DWORD()
+        _ftd2xx_module.call_ft(_ftd2xx_module._ft.FT_Read, device.handle, (ctypes.c_char * size).from_buffer(buffer),
+                               size, ctypes.byref(bytes_read))
+        return bytes_read.value
+    data = device.read(size)
+    buffer[:len(data)] = data
+    return len(data)
@@ -0,0 +1,56 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from custom_types import Vector
+from interfaces.i_sensor_controller import SensorRange
+
+SAMPLE_SIZE = 6
+
+_RAW_DTYPE = np.dtype('>i2')
+
+_X_OFFSET_25_50 = 0.038
+_Y_OFFSET_25_50 = 0.008
+_Z_OFFSET_25_50 = -0.039
+
+_X_OFFSET_100 = -0.188
+_Y_OFFSET_100 = -0.180
+_Z_OFFSET_100 = -0.179
+
+
+def sensor_offsets(sensor_range: SensorRange, calibration: Optional[Dict[SensorRange, Vector]] = None) -> Vector:
+    """ Offsets of a probe in sensor_range from its calibration, offsets per range, or the default constants. """
+    if calibration and sensor_range in calibration:
+        return calibration[sensor_range]
+    if sensor_range == SensorRange.PLUS_MINUS_100_MT:
+        return Vector(_X_OFFSET_100, _Y_OFFSET_100, _Z_OFFSET_100)
+    return Vector(_X_OFFSET_25_50, _Y_OFFSET_25_50, _Z_OFFSET_25_50)
+
+
+def _packet_counts(data) -> np.ndarray:
+    """ Samples are 6 bytes long: big-endian int16 x, y, z. Trailing bytes of an incomplete sample are ignored. """
+    samples = len(data) // SAMPLE_SIZE
+    return np.frombuffer(data, dtype=_RAW_DTYPE, count=samples * 3).reshape(samples, 3).T
+
+
+def decode_counts(data) -> np.ndarray:
+    """ Returns the raw ADC counts of any number of concatenated stream packets as a 3xN int16 array, a copy of
+    data. """
+    return _packet_counts(data).astype(np.int16)
+
+
+def counts_to_mt(counts: np.ndarray, sensor_range: SensorRange, offsets: Optional[Vector] = None) -> np.ndarray:
+    """ Converts a 3xN array of counts into x, y, z readings in mT, subtracting offsets, those of sensor_offsets() if
+    None. """
+    offsets = offsets if offsets else sensor_offsets(sensor_range)
+    scale = sensor_range.to_float() / 2.0 ** 15
+    result = np.empty(counts.shape, dtype=float)
+    np.multiply(counts, scale, out=result)
+    result -= np.array([[offsets.x], [offsets.y], [offsets.z]])
+    return result
+
+
+def decode_packets(data, sensor_range: SensorRange, offsets: Optional[Vector] = None) -> np.ndarray:
+    """ Decodes any number of concatenated stream packets into a 3xN array of x, y, z readings in mT, see
+    counts_to_mt(). """
+    return counts_to_mt(_packet_counts(data), sensor_range, offsets)
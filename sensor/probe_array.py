@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from constants import FS
+from custom_types import Vector, MeasurementsChunk, StreamStatistics
+from diagnostics.latency_tracer import LatencyTracer
+from interfaces.i_measurement_consumer import IMeasurementConsumer
+from interfaces.i_measurement_producer import IMeasurementProducer
+from interfaces.i_sensor_controller import ISensorController, SensorRange, SensorCommunicationError
+from sensor.ftd_driver import ftd2xx, DeviceError
+from sensor.sensor import Sensor
+
+logger = logging.getLogger(__name__)
+
+# samples kept per probe while waiting for the other probes, older ones are dropped
+_MAX_ALIGNMENT_BACKLOG = int(5 * FS)
+
+
+class _ProbeConsumer(IMeasurementConsumer):
+
+    def __init__(self, array: 'ProbeArray', index: int):
+        self._array = array
+        self._index = index
+
+    def feed_measurements(self, measurements: MeasurementsChunk) -> None:
+        self._array._feed(self._index, measurements)
+
+
+class ProbeArray(ISensorController, IMeasurementProducer):
+    """ Several probes acquired together, e.g. for gradient measurements, each with its own reader.
+
+    Probes are opened by serial number, all connected ones if no serials are given. Every probe numbers its samples
+    from the start of its own stream; the array shifts them by the delay between the stream starts, so sample indices
+    of all probes refer to the first probe, and hands out chunks covering the same samples of every probe. The
+    alignment is as accurate as the start commands are simultaneous, about a millisecond; drift between the probe
+    clocks is not corrected.
+
+    Towards the supervisor the array looks like a single sensor: range buttons configure all probes alike, each probe
+    keeps its own calibration offsets, and the consumer gets the aligned chunks of the first probe carrying those of
+    the other probes in MeasurementsChunk.probes. """
+
+    def __init__(self, driver=None, serials: Optional[List[bytes]] = None, tracer: Optional[LatencyTracer] = None,
+                 offsets: Optional[Dict[bytes, Dict[SensorRange, Vector]]] = None, **sensor_options):
+        """ offsets are the calibration offsets [mT] per range of the probes with the given serial numbers, see Sensor.
+        sensor_options are passed to every Sensor, e.g. latency_timer. """
+        self._driver = driver if driver else ftd2xx
+        self._serials = serials
+        self._offsets = offsets if offsets else {}
+        self._tracer = tracer
+        self._sensor_options = sensor_options
+        self._probes: List[Sensor] = []
+        self._measurement_consumer: Optional[IMeasurementConsumer] = None
+        self._lock = threading.Lock()
+        self._pending: List[List[MeasurementsChunk]] = []
+        self._alignment: List[Optional[int]] = []
+        self._aligned_index = 0
+        self._aligned_chunks = 0
+
+    @staticmethod
+    def discover_probes(driver=None) -> List[bytes]:
+        """ Returns the serial numbers of all connected probes. """
+        driver = driver if driver else ftd2xx
+        if driver is None:
+            return []
+        try:
+            devices = driver.listDevices()
+        except DeviceError:
+            return []
+        return list(devices) if devices else []
+
+    @property
+    def probes(self) -> List[Sensor]:
+        return self._probes
+
+    async def connect_and_init(self) -> None:
+        """ Closes the probes of a previous connection first, so their devices can be opened again. """
+        probes, self._probes = self._probes, []
+        await asyncio.gather(*(probe.close() for probe in probes))
+        serials = self._serials if self._serials is not None else self.discover_probes(self._driver)
+        if not serials:
+            raise SensorCommunicationError
+        # latency is traced along the first probe, the one going through the supervisor
+        probes = [Sensor(self._driver, self._tracer if index == 0 else None, serial=serial,
+                         offsets=self._offsets.get(serial), **self._sensor_options)
+                  for index, serial in enumerate(serials)]
+        results = await asyncio.gather(*(probe.connect_and_init() for probe in probes), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            await asyncio.gather(*(probe.close() for probe in probes))
+            raise failures[0]
+        for index, probe in enumerate(probes):
+            probe.attach_consumer(_ProbeConsumer(self, index))
+        self._probes = probes
+        logger.info(f"Connected probes {', '.join(serial.decode(errors='replace') for serial in serials)}")
+
+    async def reconfigure(self, sensor_range: SensorRange) -> None:
+        await asyncio.gather(*(probe.reconfigure(sensor_range) for probe in self._probes))
+
+    async def read(self) -> Vector:
+        """ Reading of the first probe. """
+        if not self._probes:
+            raise SensorCommunicationError
+        return await self._probes[0].read()
+
+    async def start_stream(self) -> None:
+        with self._lock:
+            self._pending = [[] for _ in self._probes]
+            self._alignment = [None] * len(self._probes)
+            self._aligned_index = 0
+            self._aligned_chunks = 0
+        # the first probe defines the timebase, the others are started together once it streams
+        await self._probes[0].start_stream()
+        results = await asyncio.gather(*(probe.start_stream() for probe in self._probes[1:]), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            started = [self._probes[0]] + [probe for probe, result in zip(self._probes[1:], results)
+                                           if not isinstance(result, BaseException)]
+            await asyncio.gather(*(probe.stop_stream() for probe in started), return_exceptions=True)
+            raise failures[0]
+        first_start = self._probes[0].stream_start
+        logger.debug(f"Probe alignment [samples]: "
+                     f"{[round((probe.stream_start - first_start) * FS) for probe in self._probes]}")
+
+    async def stop_stream(self) -> None:
+        await asyncio.gather(*(probe.stop_stream() for probe in self._probes))
+
+    def get_current_range(self) -> SensorRange:
+        return self._probes[0].get_current_range() if self._probes else SensorRange.PLUS_MINUS_50_MT
+
+    def get_probe_count(self) -> int:
+        return len(self._probes)
+
+    def get_offsets(self) -> Vector:
+        return self._probes[0].get_offsets() if self._probes else Vector(0.0, 0.0, 0.0)
+
+    def get_probe_ranges(self) -> List[SensorRange]:
+        return [probe.get_current_range() for probe in self._probes]
+
+    def get_probe_offsets(self) -> List[Vector]:
+        return [probe.get_offsets() for probe in self._probes]
+
+    def get_stream_statistics(self) -> StreamStatistics:
+        statistics = [probe.get_stream_statistics() for probe in self._probes]
+        return StreamStatistics(chunks=self._aligned_chunks,
+                                late_chunks=sum(s.late_chunks for s in statistics),
+                                backlog_samples=max((s.backlog_samples for s in statistics), default=0))
+
+    def attach_consumer(self, consumer: IMeasurementConsumer):
+        self._measurement_consumer = consumer
+
+
+    def _feed(self, index: int, measurements: MeasurementsChunk) -> None:
+        with self._lock:
+            if self._alignment[index] is None:
+                # the first probe started before the others
+                self._alignment[index] = round((self._probes[index].stream_start - self._probes[0].stream_start) * FS)
+            measurements.start_index += self._alignment[index]
+            pending = self._pending[index]
+            pending.append(measurements)
+            while sum(len(chunk) for chunk in pending) > _MAX_ALIGNMENT_BACKLOG:
+                pending.pop(0)
+            aligned = self._align()
+        if aligned is not None and self._measurement_consumer:
+            self._measurement_consumer.feed_measurements(aligned)
+
+    def _align(self) -> Optional[MeasurementsChunk]:
+        """ Takes the samples received from all probes out of the pending chunks, returns those of the first probe
+        carrying the others. """
+        if not all(self._pending):
+            return None
+        start = max([self._aligned_index] + [pending[0].start_index for pending in self._pending])
+        stop = min(pending[-1].stop_index for pending in self._pending)
+        if stop <= start:
+            return None
+
+        aligned = []
+        for index, pending in enumerate(self._pending):
+            merged = MeasurementsChunk.concatenate(pending)
+            a, b = start - merged.start_index, stop - merged.start_index
+            chunk = merged.slice(a, b)
+            chunk.traces = merged.traces
+            aligned.append(chunk)
+            self._pending[index] = [merged.slice(b, len(merged))] if b < len(merged) else []
+        self._aligned_index = stop
+        self._aligned_chunks += 1
+        aligned[0].probes = aligned[1:]
+        return aligned[0]
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter, sleep
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+from constants import FS
+from custom_types import Vector, MeasurementsChunk, StreamStatistics
+from diagnostics.latency_tracer import LatencyTracer, Stage, stamp
+from interfaces.i_measurement_consumer import IMeasurementConsumer
+from interfaces.i_measurement_producer import IMeasurementProducer
+from interfaces.i_sensor_controller import ISensorController, SensorRange, SensorCommunicationError
+from sensor.ftd_driver import DeviceError
+from sensor.packet_decoder import sensor_offsets
+
+logger = logging.getLogger(__name__)
+
+# 30 s of samples
+_DEFAULT_RING_CAPACITY = int(30 * FS)
+_POLL_PERIOD = 0.005
+_COMMAND_TIMEOUT = 5.0
+_HEADER_SIZE = 64
+_RING_DTYPE = np.float32
+_COUNTS_DTYPE = np.int16
+
+
+class SharedMeasurementsRing:
+    """ Ring buffer of x, y, z samples and their raw counts in shared memory, written by one process and read by
+    another.
+
+    Like MeasurementsRingBuffer every sample is written twice, capacity apart, so any window of up to capacity
+    samples is a contiguous slice. The header holds the sample index following the newest sample, published after the
+    samples are written, and the stream statistics of the writer. """
+
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        """ Creates the shared memory block, or attaches to the existing one called name. """
+        values_size = 3 * 2 * capacity * np.dtype(_RING_DTYPE).itemsize
+        size = _HEADER_SIZE + values_size + 3 * 2 * capacity * np.dtype(_COUNTS_DTYPE).itemsize
+        self._memory = SharedMemory(name=name, create=name is None, size=size if name is None else 0)
+        self._capacity = capacity
+        # stop index, chunks, late chunks, backlog samples
+        self._header = np.ndarray((4,), dtype=np.int64, buffer=self._memory.buf)
+        self._values = np.ndarray((3, 2 * capacity), dtype=_RING_DTYPE, buffer=self._memory.buf, offset=_HEADER_SIZE)
+        self._counts = np.ndarray((3, 2 * capacity), dtype=_COUNTS_DTYPE, buffer=self._memory.buf,
+                                  offset=_HEADER_SIZE + values_size)
+        if name is None:
+            self.reset()
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def stop_index(self) -> int:
+        """ Sample index following the newest sample. """
+        return int(self._header[0])
+
+    @property
+    def statistics(self) -> StreamStatistics:
+        chunks, late_chunks, backlog_samples = (int(value) for value in self._header[1:])
+        return StreamStatistics(chunks, late_chunks, backlog_samples)
+
+    def reset(self) -> None:
+        self._header[:] = 0
+
+    def publish_statistics(self, statistics: StreamStatistics) -> None:
+        self._header[1:] = (statistics.chunks, statistics.late_chunks, statistics.backlog_samples)
+
+    def write(self, measurements: MeasurementsChunk) -> None:
+        """ Writes a chunk following the previous one; chunks longer than the capacity keep their newest samples. The
+        chunk must carry its raw counts. """
+        xyz = np.vstack((measurements.x, measurements.y, measurements.z))[:, -self._capacity:]
+        counts = measurements.counts[:, -self._capacity:]
+        start = measurements.stop_index - xyz.shape[1]
+        position = start % self._capacity
+        first = min(xyz.shape[1], self._capacity - position)
+        for base in (position, position + self._capacity):
+            self._values[:, base:base + first] = xyz[:, :first]
+            self._counts[:, base:base + first] = counts[:, :first]
+        rest = xyz.shape[1] - first
+        for base in (0, self._capacity):
+            self._values[:, base:base + rest] = xyz[:, first:]
+            self._counts[:, base:base + rest] = counts[:, first:]
+        self._header[0] = measurements.stop_index
+
+    def window(self, start: int, stop: int) -> np.ndarray:
+        """ Returns a view of samples start to stop, at most capacity samples, as a 3 x N array. The view stays valid
+        while the writer is less than capacity samples ahead of start, copy it to keep it longer. """
+        position = start % self._capacity
+        return self._values[:, position:position + stop - start]
+
+    def window_counts(self, start: int, stop: int) -> np.ndarray:
+        """ Like window(), the raw counts of the samples. """
+        position = start % self._capacity
+        return self._counts[:, position:position + stop - start]
+
+    def close(self, unlink: bool = False) -> None:
+        del self._header, self._values, self._counts
+        self._memory.close()
+        if unlink:
+            self._memory.unlink()
+
+
+class _RingWriter(IMeasurementConsumer):
+
+    def __init__(self, ring: SharedMeasurementsRing, sensor: ISensorController):
+        self._ring = ring
+        self._sensor = sensor
+
+    def feed_measurements(self, measurements: MeasurementsChunk) -> None:
+        self._ring.write(measurements)
+        self._ring.publish_statistics(self._sensor.get_stream_statistics())
+
+
+def _acquisition_process(connection: Connection, ring_name: str, ring_capacity: int,
+                         driver_factory: Optional[Callable[[], Any]], sensor_options: dict) -> None:
+    """ Runs a Sensor whose stream reader writes to the shared ring, executing commands received on connection. Replies
+    carry the sequence number of their command. """
+    from sensor.sensor import Sensor
+
+    async def serve():
+        ring = SharedMeasurementsRing(ring_capacity, ring_name)
+        sensor = Sensor(driver_factory() if driver_factory else None, **sensor_options)
+        sensor.attach_consumer(_RingWriter(ring, sensor))
+        commands = {'connect': sensor.connect_and_init, 'reconfigure': sensor.reconfigure, 'read': sensor.read,
+                    'stop': sensor.stop_stream}
+
+        async def start():
+            ring.reset()
+            await sensor.start_stream()
+
+        commands['start'] = start
+        try:
+            while True:
+                sequence, command, *args = await asyncio.to_thread(connection.recv)
+                if command == 'close':
+                    break
+                try:
+                    result = commands[command](*args)
+                    if asyncio.iscoroutine(result):
+                        result = await result
+                    connection.send((sequence, 'ok', result))
+                except (SensorCommunicationError, DeviceError):
+                    connection.send((sequence, 'error', None))
+        finally:
+            ring.close()
+
+    asyncio.run(serve())
+
+
+class ProcessSensor(ISensorController, IMeasurementProducer):
+    """ Sensor running in a dedicated acquisition process, isolating USB reads and decoding from the GIL of the GUI
+    process.
+
+    The acquisition process writes decoded samples to a SharedMeasurementsRing. A thread of this process polls the
+    ring and feeds the consumer with copies of the new samples, which queues and recorders downstream may keep for
+    any time; the poller itself skips samples when it falls more than ring_capacity samples behind. Stream statistics
+    are read from the ring header, other calls are forwarded to the process as commands, awaited on worker threads of
+    the event loop.
+
+    driver_factory must be picklable, e.g. functools.partial(EmulatedDriver, fs=...); the ftd2xx module is used if
+    None. sensor_options are passed to the Sensor in the acquisition process. Latency traces start when chunks are
+    picked up from the ring. """
+
+    def __init__(self, driver_factory: Optional[Callable[[], Any]] = None, tracer: Optional[LatencyTracer] = None,
+                 ring_capacity: int = _DEFAULT_RING_CAPACITY, **sensor_options):
+        self._tracer = tracer
+        self._ring = SharedMeasurementsRing(ring_capacity)
+        self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+        self._calibration = sensor_options.get('offsets')
+        self._measurement_consumer: Optional[IMeasurementConsumer] = None
+        self._overruns = 0
+        self._poller: Optional[threading.Thread] = None
+        self._polling = False
+        self._lock = threading.Lock()
+        self._sequence = 0
+        context = multiprocessing.get_context('spawn')
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_acquisition_process, name='acquisition', daemon=True,
+                                        args=(child_connection, self._ring.name, ring_capacity, driver_factory,
+                                              sensor_options))
+        self._process.start()
+
+    @property
+    def overruns(self) -> int:
+        """ Number of times the consumer fell more than the ring capacity behind and samples were skipped. """
+        return self._overruns
+
+    async def connect_and_init(self) -> None:
+        await asyncio.to_thread(self._command, 'connect')
+        self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+
+    async def reconfigure(self, sensor_range: SensorRange) -> None:
+        await asyncio.to_thread(self._command, 'reconfigure', sensor_range)
+        self._sensor_range = sensor_range
+
+    async def read(self) -> Vector:
+        return await asyncio.to_thread(self._command, 'read')
+
+    async def start_stream(self) -> None:
+        await asyncio.to_thread(self._stop_polling)
+        await asyncio.to_thread(self._command, 'start')
+        self._overruns = 0
+        self._polling = True
+        self._poller = threading.Thread(target=self._poll_ring, name='ring-poller', daemon=True)
+        self._poller.start()
+
+    async def stop_stream(self) -> None:
+        await asyncio.to_thread(self._command, 'stop')
+        await asyncio.to_thread(self._stop_polling)
+
+    def get_current_range(self) -> SensorRange:
+        return self._sensor_range
+
+    def get_probe_count(self) -> int:
+        return 1
+
+    def get_offsets(self) -> Vector:
+        return sensor_offsets(self._sensor_range, self._calibration)
+
+    def get_probe_ranges(self) -> List[SensorRange]:
+        return [self._sensor_range]
+
+    def get_probe_offsets(self) -> List[Vector]:
+        return [self.get_offsets()]
+
+    def get_stream_statistics(self) -> StreamStatistics:
+        """ Statistics published by the acquisition process along with the latest samples. """
+        return self._ring.statistics
+
+    def attach_consumer(self, consumer: IMeasurementConsumer):
+        self._measurement_consumer = consumer
+
+    def close(self) -> None:
+        """ Stops the acquisition process and releases the shared memory. """
+        self._stop_polling()
+        if self._process.is_alive():
+            self._connection.send((None, 'close'))
+            self._process.join(_COMMAND_TIMEOUT)
+        self._ring.close(unlink=True)
+
+    def _command(self, command: str, *args) -> Any:
+        """ Sends a command and waits for its reply. Replies to earlier commands, which timed out before their replies
+        arrived, are skipped. """
+        with self._lock:
+            self._sequence += 1
+            deadline = perf_counter() + _COMMAND_TIMEOUT
+            try:
+                self._connection.send((self._sequence, command, *args))
+                while True:
+                    if not self._connection.poll(max(0.0, deadline - perf_counter())):
+                        raise SensorCommunicationError
+                    sequence, status, result = self._connection.recv()
+                    if sequence == self._sequence:
+                        break
+                    logger.warning("Skipped a late reply to an acquisition process command")
+            except (OSError, EOFError):
+                raise SensorCommunicationError
+        if status != 'ok':
+            raise SensorCommunicationError
+        return result
+
+    def _stop_polling(self) -> None:
+        self._polling = False
+        if self._poller and self._poller is not threading.current_thread():
+            self._poller.join()
+        self._poller = None
+
+    def _poll_ring(self) -> None:
+        read_index = 0
+        capacity = self._ring.capacity
+        while self._polling:
+            stop = self._ring.stop_index
+            if stop < read_index:
+                # the stream was restarted
+                read_index = 0
+            if stop - read_index > capacity:
+                self._overruns += 1
+                logger.warning(f"Acquisition ring overrun, {stop - capacity - read_index} samples skipped")
+                read_index = stop - capacity
+            if stop == read_index:
+                sleep(_POLL_PERIOD)
+                continue
+            traces = [self._tracer.new_trace()] if self._tracer else []
+            x, y, z = self._ring.window(read_index, stop).copy()
+            counts = self._ring.window_counts(read_index, stop).copy()
+            stamp(traces, Stage.DECODE)
+            chunk = MeasurementsChunk(read_index, x, y, z, traces, counts=counts)
+            read_index = stop
+            if self._measurement_consumer:
+                self._measurement_consumer.feed_measurements(chunk)
@@ -1,30 +1,41 @@
 import asyncio
+import concurrent.futures
 import logging
+import queue
+import threading
+from collections import deque
 from enum import IntEnum
-from typing import Optional, Tuple
-from time import perf_counter
-import ftd2xx as ftd
+from typing import Dict, List, Optional
+from time import perf_counter, sleep
 import numpy as np
-from ftd2xx import DeviceError, FTD2XX, ftd2xx
-from typing import List
 
 from constants import FS
-from custom_types import Vector, MeasurementsChunk
+from custom_types import Vector, MeasurementsChunk, StreamStatistics
+from diagnostics.latency_tracer import LatencyTracer, Stage, stamp
 from interfaces.i_measurement_consumer import IMeasurementConsumer
 from interfaces.i_measurement_producer import IMeasurementProducer
 from interfaces.i_sensor_controller import ISensorController, SensorRange, SensorCommunicationError
+from sensor.packet_decoder import decode_packets, decode_counts, counts_to_mt, sensor_offsets, SAMPLE_SIZE
+from sensor.ftd_driver import ftd2xx, DeviceError, FTD2XX, read_into
+from sensor.sync_async_queue import SyncToAsyncQueue, OverflowPolicy
 
 _RESPONSE_SIZE = 2
+# time for the response to a request once it is sent, and for the whole command including waiting for the I/O worker
+_RESPONSE_TIMEOUT = 1.0
+_COMMAND_TIMEOUT = 2.0
+_PURGE_RX = 1
 _CHUNK_PACKET_SIZE = 480
-_CHUNK_PERIOD = (_CHUNK_PACKET_SIZE / 6) / FS
-
-_X_OFFSET_25_50 = 0.038
-_Y_OFFSET_25_50 = 0.008
-_Z_OFFSET_25_50 = -0.039
-
-_X_OFFSET_100 = -0.188
-_Y_OFFSET_100 = -0.180
-_Z_OFFSET_100 = -0.179
+_LATE_TOLERANCE = 0.1
+_DEFAULT_LATENCY_TIMER = 2
+_DEFAULT_USB_TRANSFER_SIZE = 16384
+# about 2 s of samples, read at once when the driver has that much queued
+_DEFAULT_MAX_READ_PACKETS = 64
+_DEFAULT_POLL_RATE = 10.0
+_DEFAULT_POLL_DEPTH = 4
+# period of checking for responses while polling
+_POLL_RESPONSE_PERIOD = 0.001
+# batches of polled readings kept until read, older ones are dropped
+_MAX_PENDING_POLLED_BATCHES = 256
 
 
 class MessageType(IntEnum):
@@ -50,22 +61,41 @@ class Request:
             raise SensorCommunicationError
 
 
+# sizes of responses other than _RESPONSE_SIZE, including the message type
+_RESPONSE_SIZES = {MessageType.GET_READING: 8, MessageType.READ_REGISTER: 4}
+# requests the probe does not respond to
+_UNANSWERED = {MessageType.STOP_STREAM}
+
+
 class Response:
+    """ Response to a request of the given type. Responses of other types are stale, left by requests whose response
+    came after they timed out, and are skipped. """
 
     def __init__(self, device, message_type: MessageType):
         self._message_type = message_type
         self._device = device
 
-    def read(self) -> int:
-        result: bytes = self._device.read(_RESPONSE_SIZE)
-        message_type, data = self._decode(result)
-        if message_type != self._message_type:
-            raise SensorCommunicationError
-        return data
-
-    @staticmethod
-    def _decode(bytes_list: bytes) -> Tuple[MessageType, int]:
-        return MessageType(bytes_list[0]), bytes_list[1:]
+    def read(self, timeout: float = _RESPONSE_TIMEOUT) -> bytes:
+        """ Returns the payload following the message type. """
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            header = self._device.read(1)
+            if not header:
+                continue
+            try:
+                message_type = MessageType(header[0])
+            except ValueError:
+                # out of sync with the probe, nothing read further can be trusted
+                self._device.purge(_PURGE_RX)
+                raise SensorCommunicationError
+            size = _RESPONSE_SIZES.get(message_type, _RESPONSE_SIZE) - 1
+            payload = self._device.read(size)
+            if len(payload) != size:
+                raise SensorCommunicationError
+            if message_type == self._message_type:
+                return payload
+            logger.warning(f"Skipped a stale {message_type.name} response")
+        raise SensorCommunicationError
 
 
 logger = logging.getLogger(__name__)
@@ -73,98 +103,325 @@ logger = logging.getLogger(__name__)
 
 class Sensor(ISensorController, IMeasurementProducer):
 
-    def __init__(self):
+    def __init__(self, driver=None, tracer: Optional[LatencyTracer] = None,
+                 latency_timer: int = _DEFAULT_LATENCY_TIMER, usb_transfer_size: int = _DEFAULT_USB_TRANSFER_SIZE,
+                 max_read_packets: int = _DEFAULT_MAX_READ_PACKETS, serial: Optional[bytes] = None,
+                 offsets: Optional[Dict[SensorRange, Vector]] = None):
+        """ driver is the ftd2xx module by default, or an object providing its listDevices(), open() and openEx(),
+        e.g. an EmulatedDriver. When a tracer is given, every chunk read carries a latency trace.
+
+        Without a serial number exactly one probe must be connected; with it, the probe with that serial number is
+        opened among any number of connected ones.
+
+        latency_timer [ms] and usb_transfer_size [B] (a multiple of 64, up to 65536) configure the FTDI chip. The stream
+        reader reads all data queued by the driver, up to max_read_packets stream packets, at once.
+
+        offsets are the calibration offsets [mT] of this probe per range, the default constants are used for ranges
+        missing. """
+        self._driver = driver if driver else ftd2xx
+        self._serial = serial
+        self._tracer = tracer
+        self._latency_timer = latency_timer
+        self._usb_transfer_size = usb_transfer_size
+        self._max_read_packets = max_read_packets
+        self._read_buffer = np.empty(max_read_packets * _CHUNK_PACKET_SIZE, dtype=np.uint8)
         self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+        self._calibration = dict(offsets) if offsets else {}
         self._measurement_consumer: Optional[IMeasurementConsumer] = None
         self._device: Optional[FTD2XX] = None
         self._connected = False
-        self._t0 = 0.0
-        self._reader_task: Optional = None
-        self._stream_reading_done = True
-
-    def connect_and_init(self) -> bool:
-
-        devices = ftd.listDevices()
-        if devices is None or len(devices) != 1:
+        self._stream_start = 0.0
+        self._samples_read = 0
+        self._statistics = StreamStatistics()
+        self._reader_task: Optional[asyncio.Task] = None
+        self._streaming = False
+        self._commands: Optional[queue.Queue] = None
+        self._poller_task: Optional[asyncio.Task] = None
+        self._polling = False
+        self._poll_period = 1 / _DEFAULT_POLL_RATE
+        self._polled_batches: Optional[SyncToAsyncQueue] = None
+        self._polled = deque()
+
+    async def connect_and_init(self) -> None:
+        if self._driver is None:
             raise SensorCommunicationError
+        await self._close_device()
         try:
-            self._device = ftd.open(0)
-            self._device.setBaudRate(921600)
-            self._device.setTimeouts(1000, 1000)
-            Request(self._device, MessageType.TEST, 0).send()
-            data = Response(self._device, MessageType.TEST).read()
-            if data != bytes([0x00]):
-                raise SensorCommunicationError
-            Request(self._device, MessageType.RESET, 0).send()
-            data = Response(self._device, MessageType.RESET).read()
-            if data != bytes([0x00]):
-                raise SensorCommunicationError
-            self._connected = True
+            self._device = await asyncio.to_thread(self._open_device)
         except DeviceError:
             raise SensorCommunicationError
+        self._start_exchanger()
+        for message_type in (MessageType.TEST, MessageType.RESET):
+            if await self._exchange_messages(message_type) != bytes([0x00]):
+                raise SensorCommunicationError
+        self._sensor_range = SensorRange.PLUS_MINUS_50_MT
+        self._connected = True
 
-    def reconfigure(self, sensor_range: SensorRange) -> None:
-        Request(self._device, MessageType.SET_RANGE, int(sensor_range)).send()
-        data = Response(self._device, MessageType.SET_RANGE).read()
-        if data != bytes([0x00]):
+    async def reconfigure(self, sensor_range: SensorRange) -> None:
+        if await self._exchange_messages(MessageType.SET_RANGE, int(sensor_range)) != bytes([0x00]):
             raise SensorCommunicationError
         self._sensor_range = sensor_range
 
     async def read(self) -> Vector:
-        pass
+        """ Returns the next polled reading while polling, otherwise a reading requested on its own. """
+        if self._poller_task is None:
+            payload = await self._exchange_messages(MessageType.GET_READING)
+            if payload[0] != 0x00:
+                raise SensorCommunicationError
+            reading = decode_packets(payload[1:], self._sensor_range, self.get_offsets())
+            return Vector(*(float(value) for value in reading[:, 0]))
+        if not self._polled:
+            try:
+                batches = await self._polled_batches.get_batch(timeout=self._poll_period + _COMMAND_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise SensorCommunicationError
+            if any(batch is None for batch in batches):
+                raise SensorCommunicationError
+            self._polled.extend(np.hstack(batches).T.tolist())
+        return Vector(*self._polled.popleft())
 
-    def start_stream(self) -> None:
-        self._t0 = 0.0
-        Request(self._device, MessageType.START_STREAM, 0).send()
-        data = Response(self._device, MessageType.START_STREAM).read()
-        if data != bytes([0x00]):
+    async def start_polling(self, rate: float = _DEFAULT_POLL_RATE, depth: int = _DEFAULT_POLL_DEPTH) -> None:
+        """ Polls the probe for readings at rate [1/s], returned by read(), a light alternative to streaming when
+        only a few readings per second are needed.
+
+        Up to depth GET_READING requests are in flight at once, so the USB round trip does not limit the rate, and
+        responses that arrived together are decoded in one batch. Other commands are rejected until stop_polling(). """
+        if self._commands is None or self._streaming or self._poller_task is not None:
+            raise SensorCommunicationError
+        self._poll_period = 1 / rate
+        self._polled_batches = SyncToAsyncQueue(_MAX_PENDING_POLLED_BATCHES, OverflowPolicy.DROP_OLDEST)
+        self._polled.clear()
+        self._polling = True
+        self._poller_task = asyncio.create_task(asyncio.to_thread(self._polling_task, self._poll_period, depth))
+
+    async def stop_polling(self) -> None:
+        """ Returns when the responses to all requests sent have been read. """
+        self._polling = False
+        try:
+            if self._poller_task:
+                await self._poller_task
+        finally:
+            self._poller_task = None
+
+    async def start_stream(self) -> None:
+        self._samples_read = 0
+        self._statistics = StreamStatistics()
+        try:
+            if await self._exchange_messages(MessageType.START_STREAM) != bytes([0x00]):
+                raise SensorCommunicationError
+        except SensorCommunicationError:
+            self._streaming = False
+            raise
+        self._stream_start = perf_counter()
+        self._reader_task = asyncio.create_task(asyncio.to_thread(self._stream_reader_task))
+
+    async def stop_stream(self) -> None:
+        """ It is guaranteed that sensor will not stream more readings after this coroutine completes. The stream
+        reader is waited for, which takes the read timeout after the last packet. """
+        await self._exchange_messages(MessageType.STOP_STREAM)
+        try:
+            if self._reader_task:
+                await self._reader_task
+        except DeviceError:
             raise SensorCommunicationError
-        asyncio.create_task(asyncio.to_thread(self._stream_reader_task))
+        finally:
+            self._reader_task = None
+            self._streaming = False
 
-    def stop_stream(self) -> None:
-        """ It is guaranteed that sensor will not stream more readings after this coroutine completes. """
-        Request(self._device, MessageType.STOP_STREAM, 0).send()
+    async def close(self) -> None:
+        """ Closes the device, ending a stream or polling still running, e.g. before the probe is dropped. """
+        await self._close_device()
+        self._connected = False
 
     def get_current_range(self) -> SensorRange:
         return self._sensor_range
 
+    def get_probe_count(self) -> int:
+        return 1
+
+    def get_offsets(self) -> Vector:
+        return sensor_offsets(self._sensor_range, self._calibration)
+
+    def get_probe_ranges(self) -> List[SensorRange]:
+        return [self._sensor_range]
+
+    def get_probe_offsets(self) -> List[Vector]:
+        return [self.get_offsets()]
+
+    def get_stream_statistics(self) -> StreamStatistics:
+        return self._statistics
+
+    @property
+    def serial(self) -> Optional[bytes]:
+        return self._serial
+
+    @property
+    def stream_start(self) -> float:
+        """ perf_counter() time at which the probe confirmed the start of the stream, i.e. of sample index 0. """
+        return self._stream_start
+
     def attach_consumer(self, consumer: IMeasurementConsumer):
         self._measurement_consumer = consumer
 
-    def _exchange_messages(self, message_type: MessageType, data):
-        pass
+    def _open_device(self) -> FTD2XX:
+        devices = self._driver.listDevices()
+        if self._serial is not None:
+            if devices is None or self._serial not in devices:
+                raise SensorCommunicationError
+            device = self._driver.openEx(self._serial)
+        else:
+            if devices is None or len(devices) != 1:
+                raise SensorCommunicationError
+            device = self._driver.open(0)
+        device.setBaudRate(921600)
+        device.setTimeouts(1000, 1000)
+        device.setLatencyTimer(self._latency_timer)
+        device.setUSBParameters(self._usb_transfer_size, self._usb_transfer_size)
+        return device
+
+    async def _close_device(self) -> None:
+        """ Closes a previously opened device, e.g. one which disconnected, along with its I/O worker. A stream or
+        polling still running ends with the connection; their failures were noticed from the missing data already and
+        are dropped. """
+        if self._commands:
+            self._commands.put(None)
+            self._commands = None
+        self._polling = False
+        if self._device is not None:
+            try:
+                await asyncio.to_thread(self._device.close)
+            except DeviceError:
+                pass
+        for task in (self._reader_task, self._poller_task):
+            if task is not None:
+                await asyncio.gather(task, return_exceptions=True)
+        self._device = None
+        self._reader_task = None
+        self._streaming = False
+        self._poller_task = None
+
+    def _start_exchanger(self) -> None:
+        """ Starts the I/O worker of the opened device. """
+        self._commands = queue.Queue()
+        threading.Thread(target=self._exchanger_blocking_task, args=(self._device, self._commands),
+                         name='probe-io', daemon=True).start()
+
+    async def _exchange_messages(self, message_type: MessageType, data: int = 0) -> bytes:
+        """ Queues a request for the I/O worker and returns the payload of its response, empty for requests without
+        one. Raises SensorCommunicationError when the exchange fails or takes longer than _COMMAND_TIMEOUT. """
+        if self._commands is None:
+            raise SensorCommunicationError
+        if (self._streaming or self._poller_task is not None) and message_type not in _UNANSWERED:
+            # the stream reader or the poller owns the reads, a response would be taken for samples
+            raise SensorCommunicationError
+        if message_type == MessageType.START_STREAM:
+            self._streaming = True
+        future = concurrent.futures.Future()
+        self._commands.put((message_type, data, future))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), _COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise SensorCommunicationError
 
     @staticmethod
-    def _exchanger_blocking_task():
-        pass
+    def _exchanger_blocking_task(device, commands: queue.Queue):
+        """ I/O worker: sends the queued requests one at a time, each after the response to the previous one, and
+        resolves their futures. Requests whose futures were cancelled, e.g. by a timeout, are not sent. Ends at
+        None. """
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            message_type, data, future = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                Request(device, message_type, data).send()
+                payload = bytes() if message_type in _UNANSWERED else Response(device, message_type).read()
+            except (SensorCommunicationError, DeviceError):
+                future.set_exception(SensorCommunicationError())
+            else:
+                future.set_result(payload)
 
     def _stream_reader_task(self):
-
-        def scale(data: bytes):
-            return 2 * (np.int16((data[0] << 8) | data[1]) / 2.0 ** 16) * self._sensor_range.to_float()
-
+        """ Reads whole packets, as many as the driver has queued, into the preallocated read buffer. Bytes of an
+        incomplete sample are kept at the start of the buffer for the next read. Chunks carry the raw counts along with
+        the readings in mT. The stream ends with a read returning nothing or zeros only. """
+        buffer = memoryview(self._read_buffer)
+        offsets = self.get_offsets()
+        pending = 0
         while True:
-            data: bytes = self._device.read(_CHUNK_PACKET_SIZE)
-            if not any(data):
+            queued_packets = self._device.getQueueStatus() // _CHUNK_PACKET_SIZE
+            size = min(max(1, queued_packets), self._max_read_packets) * _CHUNK_PACKET_SIZE
+            received = read_into(self._device, buffer[pending:size])
+            if not received or not self._read_buffer[pending:pending + received].any():
                 break
-            x: List[float] = [scale(bytes([msb, lsb])) for msb, lsb in zip(data[0::6], data[1::6])]
-            y: List[float] = [scale(bytes([msb, lsb])) for msb, lsb in zip(data[2::6], data[3::6])]
-            z: List[float] = [scale(bytes([msb, lsb])) for msb, lsb in zip(data[4::6], data[5::6])]
-            t: List[float] = list((np.linspace(self._t0, self._t0 + _CHUNK_PERIOD, len(x), False, dtype=float)))
-
-            if self._sensor_range == SensorRange.PLUS_MINUS_100_MT:
-                x_off = _X_OFFSET_100
-                y_off = _Y_OFFSET_100
-                z_off = _Z_OFFSET_100
-            else:
-                x_off = _X_OFFSET_25_50
-                y_off = _Y_OFFSET_25_50
-                z_off = _Z_OFFSET_25_50
-
-            x = [e - x_off for e in x]
-            y = [e - y_off for e in y]
-            z = [e - z_off for e in z]
-            chunk = MeasurementsChunk(t, x, y, z)
+            traces = [self._tracer.new_trace()] if self._tracer else []
+            available = pending + received
+            counts = decode_counts(buffer[:available])
+            x, y, z = counts_to_mt(counts, self._sensor_range, offsets)
+            stamp(traces, Stage.DECODE)
+            pending = available % SAMPLE_SIZE
+            buffer[:pending] = buffer[available - pending:available]
+            if not len(x):
+                continue
+            chunk = MeasurementsChunk(self._samples_read, x, y, z, traces, counts=counts)
+            self._samples_read += len(x)
+            self._update_statistics()
             self._measurement_consumer.feed_measurements(chunk)
-            self._t0 += _CHUNK_PERIOD
 
+    def _polling_task(self, period: float, depth: int) -> None:
+        """ Sends a GET_READING request every period, while fewer than depth await their responses, and decodes all
+        responses that arrived at once. After polling is stopped, ends with the responses to the requests sent. On a
+        failure None is passed to read(). """
+        size = _RESPONSE_SIZES[MessageType.GET_READING]
+        offsets = self.get_offsets()
+        request = bytes([MessageType.GET_READING, 0])
+        responses = np.empty((depth, size), dtype=np.uint8)
+        buffer = memoryview(responses.reshape(-1))
+        sent = deque()
+        next_request = perf_counter()
+        try:
+            while self._polling or sent:
+                now = perf_counter()
+                if sent and now - sent[0] > _RESPONSE_TIMEOUT:
+                    raise SensorCommunicationError
+                if self._polling and now >= next_request and len(sent) < depth:
+                    self._device.write(request)
+                    sent.append(now)
+                    # after a delay polling continues at the rate instead of catching up
+                    next_request = max(next_request + period, now)
+                ready = min(self._device.getQueueStatus() // size, len(sent))
+                if ready:
+                    if read_into(self._device, buffer[:ready * size]) != ready * size:
+                        raise SensorCommunicationError
+                    batch = responses[:ready]
+                    if (batch[:, 0] != MessageType.GET_READING).any() or batch[:, 1].any():
+                        raise SensorCommunicationError
+                    self._polled_batches.put(decode_packets(batch[:, 2:].tobytes(), self._sensor_range, offsets))
+                    for _ in range(ready):
+                        sent.popleft()
+                    continue
+                wait = _POLL_RESPONSE_PERIOD if sent else next_request - now
+                sleep(max(0.0, min(wait, period)))
+        except (SensorCommunicationError, DeviceError):
+            logger.warning("Polling the probe failed")
+            self._polled_batches.put(None)
+            try:
+                self._device.purge(_PURGE_RX)
+            except DeviceError:
+                pass
+        finally:
+            self._polling = False
+
+    def _update_statistics(self) -> None:
+        """ Compares the samples read with the samples the probe produced since the stream started, according to the
+        wall clock. This is how far reading lags behind, including stalls and drift of the probe clock. Samples lost on
+        the USB side also add to it: the stream has no sample counter, so they cannot be told apart from lag, and sample
+        indices, counting the samples read, stay contiguous. """
+        elapsed = perf_counter() - self._stream_start
+        lateness = elapsed - self._samples_read / FS
+        self._statistics.chunks += 1
+        if lateness > _LATE_TOLERANCE:
+            self._statistics.late_chunks += 1
+        self._statistics.backlog_samples = max(0, int(lateness * FS))
@@ -1,14 +1,16 @@
 import asyncio
-from typing import Optional
+from typing import List, Optional
 
-from custom_types import Vector, MeasurementsChunk
+from custom_types import Vector, MeasurementsChunk, StreamStatistics
 from interfaces.i_sensor_controller import ISensorController, SensorRange
 from interfaces.i_measurement_producer import IMeasurementProducer
 from interfaces.i_measurement_consumer import IMeasurementConsumer
 import logging
 import asyncio
 import math
+import time
 import numpy as np
+from constants import FS
 
 
 logger = logging.getLogger(__name__)
@@ -34,7 +36,9 @@ class SensorStub(ISensorController, IMeasurementProducer):
         pass
 
     async def read(self) -> Vector:
-        pass
+        await asyncio.sleep(0.01)
+        t = time.monotonic()
+        return Vector(20 + 30 * math.sin(2 * 0.333 * math.pi * t), 20 * math.sin(2 * 1 * math.pi * t), 0.0)
 
     async def start_stream(self) -> None:
         await asyncio.sleep(0.1)
@@ -51,27 +55,41 @@ class SensorStub(ISensorController, IMeasurementProducer):
     def get_current_range(self) -> SensorRange:
         return self._sensor_range
 
+    def get_probe_count(self) -> int:
+        return 1
+
+    def get_offsets(self) -> Vector:
+        return Vector(0.0, 0.0, 0.0)
+
+    def get_probe_ranges(self) -> List[SensorRange]:
+        return [self._sensor_range]
+
+    def get_probe_offsets(self) -> List[Vector]:
+        return [self.get_offsets()]
+
+    def get_stream_statistics(self) -> StreamStatistics:
+        return StreamStatistics()
+
     def attach_consumer(self, consumer: IMeasurementConsumer):
         self._measurement_consumer = consumer
 
     async def _generate_readings(self):
         UPDATE_PERIOD = 0.05
-        SAMPLING_RATE = 20000
+        SAMPLING_RATE = FS
         SAMPLES_PER_UPDATE = int(SAMPLING_RATE * UPDATE_PERIOD)
         period = 0
         try:
             while True:
                 await asyncio.sleep(UPDATE_PERIOD)
                 if self._measurement_consumer:
-                    t = np.linspace((period * SAMPLES_PER_UPDATE) / SAMPLING_RATE,
-                                    ((1 + period) * SAMPLES_PER_UPDATE - 1) / SAMPLING_RATE,
-                                    SAMPLES_PER_UPDATE)
+                    start_index = period * SAMPLES_PER_UPDATE
+                    t = np.arange(start_index, start_index + SAMPLES_PER_UPDATE) / SAMPLING_RATE
                     period += 1
                     x = 20 + 30 * np.sin(2 * 0.333 * np.pi * t)  # + 30 * np.random.rand(t.size) - 30 * np.random.rand(t.size)
                     y = 20 * np.sin(2 * 1 * np.pi * t)  # + 30 * np.random.rand(t.size) - 30 * np.random.rand(t.size)
                     z = 10 * t
                     # z = 40 * np.sin(2 * 4 * np.pi * t)# + 30 * np.random.rand(t.size) - 30 * np.random.rand(t.size)
-                    fake_measurements = MeasurementsChunk(t, x, y, z)
+                    fake_measurements = MeasurementsChunk(start_index, x, y, z)
                     self._measurement_consumer.feed_measurements(fake_measurements)
         except:
             logger.info("_generate_readings cancelled")
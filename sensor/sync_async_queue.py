@@ -1,15 +1,134 @@
 import asyncio
-from queue import Queue, Empty
+import threading
+from collections import deque
+from enum import Enum
+from typing import Any, Callable, List, Optional
 
 
-class SyncToAsyncQueue(Queue):
-    def __init__(self, size: int = 0, timeout: float = 0.02):
-        super().__init__(size)
-        self._timeout = timeout
+class OverflowPolicy(Enum):
+    """ What put() does when the queue is full.
 
-    async def aget(self):
+    BLOCK: the producer waits until the consumer drains the queue, pushing back on the data source.
+    DROP_OLDEST: the oldest pending item is discarded.
+    COALESCE: the item is merged into the newest pending one, nothing is lost but the consumer gets fewer, larger
+    items; when the merge is refused, e.g. because the merged item would grow too large, the oldest pending item is
+    dropped as with DROP_OLDEST. """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+
+
+class SyncToAsyncQueue:
+    """ Passes items from any thread to a single consumer coroutine running on the event loop.
+
+    Producers never touch the event loop directly: the first item put while the consumer is waiting schedules a single
+    thread-safe wakeup, and the consumer then drains everything pending in one batch.
+
+    With maxsize > 0 the queue is bounded and overflow is handled according to policy; coalesce(older, newer) merges
+    two items for OverflowPolicy.COALESCE, or returns None to refuse the merge. Dropped, coalesced and blocked puts
+    are counted. With OverflowPolicy.BLOCK put() must not be called from the event loop thread. """
+
+    def __init__(self, maxsize: int = 0, policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                 coalesce: Optional[Callable[[Any, Any], Optional[Any]]] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        if policy == OverflowPolicy.COALESCE and coalesce is None:
+            raise ValueError('COALESCE policy needs a coalesce function')
+        self._loop = loop if loop else asyncio.get_running_loop()
+        self._maxsize = maxsize
+        self._policy = policy
+        self._coalesce = coalesce
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._waiter: Optional[asyncio.Future] = None
+        self._wakeup_scheduled = False
+        self._dropped = 0
+        self._coalesced = 0
+        self._blocked = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def policy(self) -> OverflowPolicy:
+        return self._policy
+
+    @property
+    def dropped(self) -> int:
+        """ Number of items discarded by OverflowPolicy.DROP_OLDEST, or by OverflowPolicy.COALESCE when a merge was
+        refused. """
+        return self._dropped
+
+    @property
+    def coalesced(self) -> int:
+        """ Number of items merged into a pending one by OverflowPolicy.COALESCE. """
+        return self._coalesced
+
+    @property
+    def blocked(self) -> int:
+        """ Number of puts which had to wait for space with OverflowPolicy.BLOCK. """
+        return self._blocked
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self._dropped = 0
+            self._coalesced = 0
+            self._blocked = 0
+
+    def put(self, item: Any) -> None:
+        with self._lock:
+            if self._maxsize and len(self._items) >= self._maxsize:
+                if self._policy == OverflowPolicy.BLOCK:
+                    self._blocked += 1
+                    while len(self._items) >= self._maxsize:
+                        self._not_full.wait()
+                    self._items.append(item)
+                else:
+                    merged = self._coalesce(self._items[-1], item) \
+                        if self._policy == OverflowPolicy.COALESCE else None
+                    if merged is not None:
+                        self._items[-1] = merged
+                        self._coalesced += 1
+                    else:
+                        self._items.popleft()
+                        self._dropped += 1
+                        self._items.append(item)
+            else:
+                self._items.append(item)
+            wakeup = self._waiter is not None and not self._wakeup_scheduled
+            if wakeup:
+                self._wakeup_scheduled = True
+        if wakeup:
+            self._loop.call_soon_threadsafe(self._wake_consumer)
+
+    async def get_batch(self, timeout: Optional[float] = None) -> List[Any]:
+        """ Waits until at least one item is available and returns all pending items in order.
+
+        Raises asyncio.TimeoutError if nothing arrives within timeout seconds. """
         while True:
+            with self._lock:
+                if self._items:
+                    return self._drain()
+                self._waiter = self._loop.create_future()
+                self._wakeup_scheduled = False
             try:
-                return self.get_nowait()
-            except Empty:
-                await asyncio.sleep(self._timeout)
+                await asyncio.wait_for(self._waiter, timeout)
+            finally:
+                with self._lock:
+                    self._waiter = None
+
+    def clear(self) -> None:
+        """ Drops pending items, releasing blocked producers. """
+        with self._lock:
+            self._items.clear()
+            self._not_full.notify_all()
+
+    def _drain(self) -> List[Any]:
+        items = list(self._items)
+        self._items.clear()
+        self._not_full.notify_all()
+        return items
+
+    def _wake_consumer(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
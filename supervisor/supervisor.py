@@ -3,17 +3,39 @@ from interfaces.i_gui_controller import IGuiController
 from interfaces.i_measurement_consumer import IMeasurementConsumer
 from interfaces.i_sensor_controller import ISensorController, SensorRange
 from interfaces.i_sensor_controller import SensorCommunicationError
-from custom_types import MeasurementsChunk
+from interfaces.i_export_job import IExportJob
+from custom_types import MeasurementsChunk, MeasurementsRingBuffer, SessionInfo
+from diagnostics.latency_tracer import LatencyTracer, Stage, stamp
+from sensor.sync_async_queue import SyncToAsyncQueue, OverflowPolicy
 import asyncio
+from dataclasses import replace
 from enum import Enum
 import logging
+import time
 from file_handler.file_handler import FileHandler, InvalidFileError
+from file_handler.stream_recorder import StreamRecorder
 from constants import FS
-from typing import Optional
+from typing import List, Optional
 
 logger = logging.getLogger(__name__)
 
 _MAX_FILE_TIME = 120
+# about 8 s of 80 sample chunks
+_MAX_PENDING_CHUNKS = 256
+# chunks are merged while the queue is full up to 1 s of samples each, so its memory stays bounded
+_MAX_COALESCED_SAMPLES = int(FS)
+_EXPORT_PROGRESS_PERIOD = 0.25
+
+
+def _coalesce_chunks(older: MeasurementsChunk, newer: MeasurementsChunk) -> Optional[MeasurementsChunk]:
+    if len(older) + len(newer) > _MAX_COALESCED_SAMPLES or older.stop_index != newer.start_index:
+        return None
+    return MeasurementsChunk.concatenate([older, newer])
+
+
+def _shift_chunk(measurements: MeasurementsChunk, offset: int) -> None:
+    for chunk in [measurements] + measurements.probes:
+        chunk.start_index += offset
 
 
 class AppState(Enum):
@@ -24,30 +46,86 @@ class AppState(Enum):
 
 
 class Supervisor(IGuiObserver, IMeasurementConsumer):
-    def __init__(self, gui_controller: IGuiController, sensor_controller: ISensorController):
+    def __init__(self, gui_controller: IGuiController, sensor_controller: ISensorController,
+                 tracer: Optional[LatencyTracer] = None, overflow_policy: OverflowPolicy = OverflowPolicy.COALESCE,
+                 max_pending_chunks: int = _MAX_PENDING_CHUNKS, raw_counts: bool = False):
+        """ Chunks fed by the sensor wait in a queue bounded to max_pending_chunks; when processing falls behind,
+        overflow_policy decides whether the sensor is blocked, the oldest chunks are dropped or new chunks are merged
+        into pending ones, up to a size past which the oldest are dropped. With raw_counts session files store raw
+        counts with their calibration instead of mT. """
         self._gui = gui_controller
         self._sensor = sensor_controller
-        self._measurements_queue = asyncio.Queue()
-        self._measurements_buffer = MeasurementsChunk([], [], [], [])
+        self._tracer = tracer
+        self._raw_counts = raw_counts
+        self._measurements_queue = SyncToAsyncQueue(max_pending_chunks, overflow_policy, _coalesce_chunks)
+        self._reported_overflow = (0, 0, 0)
+        self._next_index: Optional[int] = None
+        self._lost_samples = 0
+        # added to the sample indices of the stream, which restarts from 0 after a range change while reading
+        self._index_offset = 0
+        # raw count saves take the counts kept by the buffer
+        self._measurements_buffer = MeasurementsRingBuffer(int(FS * _MAX_FILE_TIME), counts=raw_counts)
         self._app_state = AppState.SENSOR_DISCONNECTED
         self._update_gui_buttons()
         self._reader_task: Optional[asyncio.Task] = None
+        self._recorder: Optional[StreamRecorder] = None
+        self._reported_recorder_drops = 0
+        self._session_info: Optional[SessionInfo] = None
+        self._samples_received = 0
+        self._export_jobs: List[IExportJob] = []
         asyncio.create_task(self._connect_to_sensor())
 
+    @property
+    def app_state(self) -> AppState:
+        return self._app_state
+
+    @property
+    def samples_received(self) -> int:
+        """ Number of samples processed since the last start. """
+        return self._samples_received
+
     def on_start_button(self) -> None:
         if self._app_state == AppState.STANDBY:
             self._app_state = AppState.TRANSITION
-            self._measurements_buffer = MeasurementsChunk([], [], [], [])
+            channels = 3 * self._sensor.get_probe_count()
+            if self._measurements_buffer.channels != channels:
+                # the buffer is too narrow, new measurements go to a new one
+                self._measurements_buffer = MeasurementsRingBuffer(self._measurements_buffer.capacity,
+                                                                   channels=channels, counts=self._raw_counts)
+            else:
+                self._measurements_buffer.clear()
+            self._samples_received = 0
+            self._index_offset = 0
+            if self._tracer:
+                self._tracer.reset()
+            self._session_info = self._make_session_info()
             self._gui.reset_graph()
             self._gui.reset_measurement_text_field()
             self._update_gui_buttons()
             self._reader_task = asyncio.create_task(self._read())
 
+    def on_record_button(self) -> None:
+        if self._app_state == AppState.STANDBY:
+            path = FileHandler().ask_recording_path()
+            if path:
+                self.start_recording(path)
+
+    def start_recording(self, path: str) -> None:
+        """ Starts reading like the start button and streams every chunk to the file at path until stopped. """
+        if self._app_state == AppState.STANDBY:
+            self._recorder = StreamRecorder(path, self._make_session_info(), self._raw_counts)
+            self._reported_recorder_drops = 0
+            self.on_start_button()
+
     def on_stop_button(self) -> None:
+        asyncio.create_task(self.stop())
+
+    async def stop(self) -> None:
+        """ Stops reading like the stop button and returns when the sensor stopped streaming. """
         if self._app_state == AppState.READING:
             self._app_state = AppState.TRANSITION
             self._update_gui_buttons()
-            self._stop_reading()
+            await self._stop_reading()
 
     def on_25_mt_range_button(self) -> None:
         self._change_range_if_needed(SensorRange.PLUS_MINUS_25_MT)
@@ -60,25 +138,44 @@ class Supervisor(IGuiObserver, IMeasurementConsumer):
 
     def on_explore_data_button(self) -> None:
         print("Starting plotly")
-        try:
-            FileHandler().explore_file()
-        except InvalidFileError:
-            self._gui.show_info('Invalid file selected',
-                                warning=True)
+        asyncio.create_task(self._explore())
 
     def on_save_data_button(self) -> None:
         print("Saving data to csv")
-        FileHandler().save_to_file(self._measurements_buffer)
+        if self._session_info:
+            job = FileHandler().save_to_file(self._measurements_buffer.last(), self._session_info, self._raw_counts)
+            if job:
+                self._export_jobs.append(job)
+                asyncio.create_task(self._follow_export(job))
+
+    def on_cancel_export_button(self) -> None:
+        for job in self._export_jobs:
+            job.cancel()
+
+    async def wait_for_exports(self) -> None:
+        """ Returns when all running saves are done. """
+        await asyncio.gather(*(asyncio.to_thread(job.wait) for job in self._export_jobs))
+
+    def on_diagnostics_button(self) -> None:
+        statistics = self._sensor.get_stream_statistics()
+        queue = self._measurements_queue
+        self._gui.show_diagnostics(
+            f'Chunks read: {statistics.chunks}, late: {statistics.late_chunks}, '
+            f'backlog: {statistics.backlog_samples} samples\n'
+            f'Samples lost: {self._lost_samples}\n'
+            f'Queue policy: {queue.policy.value}, dropped: {queue.dropped}, coalesced: {queue.coalesced}, '
+            f'blocked: {queue.blocked}\n\n' +
+            (self._tracer.report() if self._tracer else 'Latency tracing disabled'))
 
     def feed_measurements(self, measurements: MeasurementsChunk) -> None:
         if self._app_state == AppState.READING:
-            self._measurements_queue.put_nowait(measurements)
-            pass
+            stamp(measurements.traces, Stage.ENQUEUE)
+            self._measurements_queue.put(measurements)
 
     async def _connect_to_sensor(self):
         while True:
             try:
-                self._sensor.connect_and_init()
+                await self._sensor.connect_and_init()
                 break
             except SensorCommunicationError:
                 self._gui.show_info('Probe not connected, multiple probes connected or ftd2xx drivers not installed',
@@ -88,61 +185,159 @@ class Supervisor(IGuiObserver, IMeasurementConsumer):
         self._update_gui_buttons()
 
     async def _read(self):
-
-        async def get_from_queue(queue, content):
-            chunk: MeasurementsChunk = await queue.get()
-            content.extend(chunk)
         try:
             self._app_state = AppState.READING
-            self._flush_measurements_queue()
-            self._sensor.start_stream()
+            self._reset_measurements_queue()
+            await self._sensor.start_stream()
             self._update_gui_buttons()
 
-            i = 0
             while True:
-                measurements: Optional[MeasurementsChunk] = MeasurementsChunk([], [], [], [])
-                await asyncio.wait_for(get_from_queue(self._measurements_queue, measurements), timeout=0.2)
-                self._gui.update_measurement_text_field(measurements)
-                self._gui.update_graph(measurements)
-                self._measurements_buffer.extend(measurements)
-                i += 1
-                if i > 100:
-                    i = 0
-                    self._measurements_buffer.drop_older_than(int(FS * _MAX_FILE_TIME))
+                chunks = await self._measurements_queue.get_batch(timeout=0.2)
+                if self._index_offset:
+                    for measurements in chunks:
+                        _shift_chunk(measurements, self._index_offset)
+                for measurements in self._join_contiguous(chunks):
+                    stamp(measurements.traces, Stage.DEQUEUE)
+                    self._gui.update_measurements(measurements)
+                    self._measurements_buffer.extend(measurements)
+                    self._samples_received += len(measurements)
+                    await self._record(measurements)
+                self._report_overflow()
         except (SensorCommunicationError, asyncio.TimeoutError):
+            await self._close_recorder()
             if self._app_state == AppState.READING:
                 self._app_state = AppState.SENSOR_DISCONNECTED
                 await self._connect_to_sensor()
 
-    def _stop_reading(self):
-        self._sensor.stop_stream()
+    def _join_contiguous(self, chunks: List[MeasurementsChunk]) -> List[MeasurementsChunk]:
+        """ Concatenates the chunks following each other. Samples missing in the gaps between chunks are counted: chunks
+        dropped from the queue, skipped by an acquisition ring overrun or left out when aligning probes. Samples lost on
+        the USB side do not leave gaps, they show in the backlog of the stream statistics. """
+        joined = MeasurementsChunk.join_contiguous(chunks)
+        for measurements in joined:
+            if self._next_index is not None and measurements.start_index > self._next_index:
+                self._lost_samples += measurements.start_index - self._next_index
+            self._next_index = measurements.stop_index
+        return joined
+
+    def _report_overflow(self):
+        queue = self._measurements_queue
+        overflow = (queue.coalesced, queue.dropped, self._lost_samples)
+        if overflow != self._reported_overflow:
+            self._reported_overflow = overflow
+            self._gui.show_info(f'Measurements fall behind, {queue.coalesced} chunks merged, {queue.dropped} '
+                                f'dropped, {self._lost_samples} samples lost', warning=True)
+
+    async def _stop_reading(self):
+        try:
+            await self._sensor.stop_stream()
+        except SensorCommunicationError:
+            self._reader_task.cancel()
+            await self._close_recorder()
+            self._app_state = AppState.SENSOR_DISCONNECTED
+            await self._connect_to_sensor()
+            return
         self._reader_task.cancel()
+        self._flush_measurements_queue()
+        await self._close_recorder()
         self._app_state = AppState.STANDBY
         self._update_gui_buttons()
 
-    def _reconfigure(self, sensor_range: SensorRange):
-        self._sensor.reconfigure(sensor_range)
+    async def _explore(self):
+        try:
+            await asyncio.to_thread(FileHandler.explore_file)
+        except InvalidFileError:
+            self._gui.show_info('Invalid file selected',
+                                warning=True)
+
+    async def _follow_export(self, job: IExportJob):
+        self._gui.set_cancel_export_button(True)
+        while not job.done:
+            self._gui.show_info(f'Saving to {job.path}: {job.progress:.0%}')
+            await asyncio.sleep(_EXPORT_PROGRESS_PERIOD)
+        self._export_jobs.remove(job)
+        if not self._export_jobs:
+            self._gui.set_cancel_export_button(False)
+        if job.error:
+            self._gui.show_info(f'Saving to {job.path} failed', warning=True)
+        elif job.cancelled:
+            self._gui.show_info(f'Saving to {job.path} cancelled')
+        else:
+            self._gui.show_info(f'Saved {job.path}')
+
+    async def _record(self, measurements: MeasurementsChunk):
+        if self._recorder:
+            self._recorder.write(measurements)
+            if self._recorder.error:
+                self._gui.show_info(f'Recording to {self._recorder.path} failed', warning=True)
+                await self._close_recorder()
+            elif self._recorder.dropped_chunks != self._reported_recorder_drops:
+                self._reported_recorder_drops = self._recorder.dropped_chunks
+                self._gui.show_info(f'Disk falls behind, {self._reported_recorder_drops} chunks not recorded',
+                                    warning=True)
+
+    async def _close_recorder(self):
+        if self._recorder:
+            recorder, self._recorder = self._recorder, None
+            await asyncio.to_thread(recorder.close)
+
+    def _make_session_info(self) -> SessionInfo:
+        offsets = self._sensor.get_offsets()
+        probe_offsets = self._sensor.get_probe_offsets()[1:]
+        return SessionInfo(fs=FS, sensor_range=self._sensor.get_current_range().to_float(),
+                           offsets=[offsets.x, offsets.y, offsets.z], start_time=time.time(),
+                           probes=self._sensor.get_probe_count(),
+                           probe_ranges=[probe_range.to_float() for probe_range in self._sensor.get_probe_ranges()[1:]],
+                           probe_offsets=[[offsets.x, offsets.y, offsets.z] for offsets in probe_offsets])
+
+    async def _reconfigure(self, sensor_range: SensorRange):
+        try:
+            await self._sensor.reconfigure(sensor_range)
+        except SensorCommunicationError:
+            self._app_state = AppState.SENSOR_DISCONNECTED
+            await self._connect_to_sensor()
+            return
         self._current_sensor_range = sensor_range
         self._app_state = AppState.STANDBY
         self._update_gui_buttons()
 
+    async def _reconfigure_while_reading(self, sensor_range: SensorRange):
+        """ Pauses the stream for the range change. Reading goes on after a gap of about the samples missed meanwhile,
+        a recording in a new calibration segment. The measurements buffer starts over, so a save holds a single
+        range. """
+        paused_at = time.perf_counter()
+        self._reader_task.cancel()
+        try:
+            await self._sensor.stop_stream()
+            await self._sensor.reconfigure(sensor_range)
+        except SensorCommunicationError:
+            await self._close_recorder()
+            self._app_state = AppState.SENSOR_DISCONNECTED
+            await self._connect_to_sensor()
+            return
+        self._index_offset = (self._next_index or self._index_offset) + round((time.perf_counter() - paused_at) * FS)
+        info = replace(self._make_session_info(), start_time=self._session_info.start_time)
+        if self._recorder:
+            self._recorder.set_calibration(self._index_offset, info)
+        self._session_info = info
+        self._measurements_buffer.clear()
+        self._reader_task = asyncio.create_task(self._read())
+
     def _change_range_if_needed(self, new_range: SensorRange):
-        if self._app_state == AppState.STANDBY:
+        if self._app_state in (AppState.STANDBY, AppState.READING):
             if self._sensor.get_current_range() != new_range:
+                reading = self._app_state == AppState.READING
                 self._app_state = AppState.TRANSITION
                 self._update_gui_buttons()
-                try:
-                    self._reconfigure(new_range)
-                except SensorCommunicationError:
-                    self._app_state = AppState.SENSOR_DISCONNECTED
-                    asyncio.create_task(self._connect_to_sensor())
-                    return
+                asyncio.create_task(self._reconfigure_while_reading(new_range) if reading
+                                    else self._reconfigure(new_range))
 
     def _update_gui_buttons(self):
 
         def disable_all_buttons():
             self._gui.set_range_buttons_active(False)
             self._gui.set_start_button_active(False)
+            self._gui.set_record_button_active(False)
             self._gui.set_stop_button_active(False)
             self._gui.set_explore_data_button(False)
             self._gui.set_save_data_button(False)
@@ -156,19 +351,25 @@ class Supervisor(IGuiObserver, IMeasurementConsumer):
             disable_all_buttons()
             self._gui.show_info("Standby")
             self._gui.set_start_button_active(True)
+            self._gui.set_record_button_active(True)
             self._gui.set_range_buttons_active(True)
             self._gui.set_explore_data_button(True)
             self._gui.set_save_data_button(True)
         elif self._app_state == AppState.READING:
             disable_all_buttons()
-            self._gui.show_info("Reading")
+            self._gui.show_info(f"Recording to {self._recorder.path}" if self._recorder else "Reading")
             self._gui.set_stop_button_active(True)
+            self._gui.set_range_buttons_active(True)
+            self._gui.set_explore_data_button(True)
 
         self._gui.highlight_range_button(self._sensor.get_current_range())
 
     def _flush_measurements_queue(self):
-        while True:
-            try:
-                _ = self._measurements_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                return
+        self._measurements_queue.clear()
+
+    def _reset_measurements_queue(self):
+        self._flush_measurements_queue()
+        self._measurements_queue.reset_counters()
+        self._reported_overflow = (0, 0, 0)
+        self._next_index = None
+        self._lost_samples = 0
@@ -0,0 +1,323 @@
+""" Benchmarks of the acquisition, processing, rendering and file hot paths.
+
+Run from the repository root:
+    python test/benchmark.py                  compare with the stored baseline
+    python test/benchmark.py --save-baseline  store the results as the new baseline
+    python test/benchmark.py -k file          run only benchmarks with 'file' in their name
+
+Results are the median time per call over several repeats. The baseline depends on the machine and is not committed,
+save one before making changes to compare with. Benchmarks faster than 50 ms vary more between runs and are flagged
+only from a larger slowdown. Benchmarks that need Kivy are skipped when it is not installed. """
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from pandas import read_csv
+
+from constants import FS
+from custom_types import MeasurementsChunk, MeasurementsRingBuffer, SessionInfo
+from file_handler.lod_pyramid import LodPyramid
+from file_handler.session_file import SessionFile
+from file_handler.writers import create_writer
+from file_handler.csv_loader import load_csv
+from gui.decimation import MinMaxDecimator
+from interfaces.i_sensor_controller import SensorRange
+from processing.filter_bank import FilterBank, FilterSpec
+from processing.spectrum import WelchAccumulator
+from sensor.packet_decoder import decode_packets
+from sensor.sensor import Sensor
+
+_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+_REGRESSION_THRESHOLD = 1.25
+_SHORT_BENCHMARK_TIME = 0.05
+_SHORT_REGRESSION_THRESHOLD = 1.6
+_REPEAT = 5
+_PACKET_SIZE = 480
+_CHUNK_SAMPLES = _PACKET_SIZE // 6
+_RECORDING_MINUTES = [1, 10, 60]
+
+Benchmark = Callable[[], Callable[[], None]]
+_benchmarks: List[Tuple[str, Benchmark]] = []
+
+
+class _SkipBenchmark(Exception):
+    pass
+
+
+def benchmark(name: str):
+    """ Registers a setup function returning the callable to be timed. """
+    def register(setup: Benchmark) -> Benchmark:
+        _benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+def _random_packets(count: int) -> bytes:
+    return np.random.default_rng(0).integers(-2 ** 15, 2 ** 15, count * _PACKET_SIZE // 2).astype('>i2').tobytes()
+
+
+def _measurements(samples: int) -> MeasurementsChunk:
+    t = np.arange(samples) / FS
+    rng = np.random.default_rng(0)
+    return MeasurementsChunk(0, *(10.0 * np.sin(2 * np.pi * t) + rng.normal(size=samples) for _ in range(3)))
+
+
+def _chunks(samples: int, chunk_size: int = _CHUNK_SAMPLES) -> List[MeasurementsChunk]:
+    data = _measurements(samples)
+    return [MeasurementsChunk(i, data.x[i:i + chunk_size], data.y[i:i + chunk_size], data.z[i:i + chunk_size])
+            for i in range(0, samples, chunk_size)]
+
+
+class _ReplayDevice:
+    """ Returns prepared packets from read(), then an empty read which ends the stream reader. At most
+    queued_packets packets are reported as queued at a time. """
+
+    def __init__(self, data: bytes, queued_packets: int):
+        self._data = data
+        self._position = 0
+        self._queued_packets = queued_packets
+
+    def getQueueStatus(self) -> int:
+        return min(len(self._data) - self._position, self._queued_packets * _PACKET_SIZE)
+
+    def read(self, size: int) -> bytes:
+        result = self._data[self._position:self._position + size]
+        self._position += len(result)
+        return result
+
+
+class _NullConsumer:
+
+    def feed_measurements(self, measurements: MeasurementsChunk) -> None:
+        pass
+
+
+@benchmark('decode: decode_packets, 1 packet')
+def _decode_packet():
+    data = _random_packets(1)
+    return lambda: decode_packets(data, SensorRange.PLUS_MINUS_50_MT)
+
+
+@benchmark('decode: decode_packets, 100 packets')
+def _decode_packets():
+    data = _random_packets(100)
+    return lambda: decode_packets(data, SensorRange.PLUS_MINUS_50_MT)
+
+
+def _stream_reader(queued_packets: int):
+    data = _random_packets(100)
+    sensor = Sensor()
+    sensor.attach_consumer(_NullConsumer())
+
+    def run():
+        sensor._device = _ReplayDevice(data, queued_packets)
+        sensor._stream_reader_task()
+    return run
+
+
+benchmark('decode: Sensor._stream_reader_task, 100 packets')(lambda: _stream_reader(1))
+benchmark('decode: Sensor._stream_reader_task, 100 packets, 10 queued')(lambda: _stream_reader(10))
+
+
+@benchmark('buffer: MeasurementsChunk.extend + drop_older_than, 10 s of chunks')
+def _chunk_extend():
+    chunks = _chunks(int(10 * FS))
+
+    def run():
+        buffer = MeasurementsChunk(0, [], [], [])
+        for i, chunk in enumerate(chunks):
+            buffer.extend(chunk)
+            if i % 100 == 0:
+                buffer.drop_older_than(int(FS * 5))
+    return run
+
+
+@benchmark('buffer: MeasurementsRingBuffer.extend, 10 s of chunks')
+def _ring_buffer_extend():
+    chunks = _chunks(int(10 * FS))
+    buffer = MeasurementsRingBuffer(int(FS * 5))
+
+    def run():
+        for chunk in chunks:
+            buffer.extend(chunk)
+    return run
+
+
+@benchmark('processing: FilterBank.process, 2 filters, 1 s of chunks')
+def _filter_bank():
+    chunks = _chunks(int(FS))
+    bank = FilterBank()
+    bank.subscribe(FilterSpec(order=5, cutoff=2.0), lambda chunk, filtered: None)
+    bank.subscribe(FilterSpec(order=8, cutoff=33.0), lambda chunk, filtered: None)
+
+    def run():
+        for chunk in chunks:
+            bank.process(chunk)
+    return run
+
+
+@benchmark('processing: WelchAccumulator.update, 1 s segments, 1 s of chunks')
+def _welch():
+    chunks = _chunks(int(FS))
+    accumulator = WelchAccumulator()
+
+    def run():
+        for chunk in chunks:
+            accumulator.update(chunk.start_index, np.vstack((chunk.x, chunk.y, chunk.z)))
+    return run
+
+
+@benchmark('rendering: MinMaxDecimator.process, 1 s of chunks')
+def _decimator():
+    chunks = _chunks(int(FS))
+    decimator = MinMaxDecimator(31)
+
+    def run():
+        for chunk in chunks:
+            decimator.process(chunk.t, np.vstack((chunk.x, chunk.y, chunk.z)))
+    return run
+
+
+def _kivy_widget(name: str):
+    try:
+        import gui.gui_frontend as frontend
+    except ImportError:
+        raise _SkipBenchmark('Kivy not installed')
+    return getattr(frontend, name)()
+
+
+@benchmark('rendering: CustomGraph.update_data + update_plot, 1 s of 32 ms frames')
+def _graph():
+    graph = _kivy_widget('CustomGraph')
+    bank = FilterBank()
+    graph.attach_filter_bank(bank)
+    frames = _chunks(int(FS), chunk_size=_CHUNK_SAMPLES)
+
+    def run():
+        graph.reset()
+        for frame in frames:
+            bank.process(frame)
+            graph.update_plot()
+    return run
+
+
+@benchmark('rendering: FilteredMeasurements.update, 1 s of chunks')
+def _readout():
+    readout = _kivy_widget('FilteredMeasurements')
+    bank = FilterBank()
+    readout.attach_filter_bank(bank)
+    chunks = _chunks(int(FS))
+
+    def run():
+        readout.reset()
+        for chunk in chunks:
+            bank.process(chunk)
+    return run
+
+
+def _register_file_benchmarks():
+    info = SessionInfo(fs=FS, sensor_range=50.0, offsets=[0.0, 0.0, 0.0], start_time=0.0)
+    directory = tempfile.mkdtemp(prefix='usb-magnetometer-benchmark-')
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+
+    for minutes in _RECORDING_MINUTES:
+        for extension, raw_counts in (('.csv', False), ('.mag', False), ('.mag', True)):
+            suffix = ' raw counts' if raw_counts else ''
+            path = os.path.join(directory, f'{minutes}min{"-raw" if raw_counts else ""}{extension}')
+
+            def save(path=path, minutes=minutes, raw_counts=raw_counts):
+                measurements = _measurements(int(minutes * 60 * FS))
+
+                def run():
+                    writer = create_writer(path, info, raw_counts)
+                    writer.write(measurements)
+                    writer.close()
+                return run
+
+            def load(path=path, extension=extension):
+                if not os.path.exists(path):
+                    raise _SkipBenchmark('run the save benchmark first')
+                if extension == '.csv':
+                    return lambda: read_csv(path)
+                return lambda: LodPyramid.build(SessionFile(path))
+
+            def load_chunked(path=path):
+                if not os.path.exists(path):
+                    raise _SkipBenchmark('run the save benchmark first')
+                return lambda: LodPyramid.build(load_csv(path, np.float32))
+
+            benchmark(f'file: save {minutes} min {extension}{suffix}')(save)
+            benchmark(f'file: load {minutes} min {extension}{suffix}' +
+                      (' (memory map + LOD pyramid)' if extension == '.mag' else ''))(load)
+            if extension == '.csv':
+                benchmark(f'file: load {minutes} min .csv (chunked float32 loader + LOD pyramid)')(load_chunked)
+
+
+_register_file_benchmarks()
+
+
+def _time(setup: Benchmark) -> float:
+    timer = timeit.Timer(setup())
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(_REPEAT, number)) / number
+
+
+def _load_baseline() -> Optional[dict]:
+    if not os.path.exists(_BASELINE_PATH):
+        return None
+    with open(_BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--filter', default='', help='run only benchmarks whose name contains this text')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    baseline = _load_baseline()
+    baseline_results: Dict[str, float] = baseline['results'] if baseline else {}
+    results: Dict[str, float] = {}
+    regressions = 0
+    for name, setup in _benchmarks:
+        if args.filter not in name:
+            continue
+        try:
+            results[name] = _time(setup)
+        except _SkipBenchmark as e:
+            print(f'{name:80} skipped: {e}')
+            continue
+        line = f'{name:80} {results[name] * 1e3:12.3f} ms'
+        if name in baseline_results:
+            ratio = results[name] / baseline_results[name]
+            line += f'  {ratio:6.2f}x baseline'
+            threshold = _SHORT_REGRESSION_THRESHOLD if baseline_results[name] < _SHORT_BENCHMARK_TIME \
+                else _REGRESSION_THRESHOLD
+            if ratio > threshold:
+                line += '  REGRESSION'
+                regressions += 1
+        print(line)
+
+    if args.save_baseline:
+        baseline_results.update(results)
+        with open(_BASELINE_PATH, 'w') as f:
+            json.dump({'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                                   'python': platform.python_version(), 'numpy': np.__version__},
+                       'results': baseline_results}, f, indent=2)
+        print(f'Baseline saved to {_BASELINE_PATH}')
+    return 1 if regressions and not args.save_baseline else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())